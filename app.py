@@ -1,24 +1,59 @@
-import json, os, logging, random, threading, time, requests
+import atexit, bisect, hmac, json, mmap, os, logging, queue, random, re, signal, sqlite3, sys, threading, time, zlib, requests, urllib3
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
 from flask import Flask, request, abort
 
-from linebot.v3 import WebhookHandler
+from linebot.v3 import WebhookHandler, WebhookParser
+from linebot.v3.webhook import SignatureValidator
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
     Configuration, ApiClient, MessagingApi,
-    ReplyMessageRequest, TextMessage,
     FlexMessage, FlexContainer,
     QuickReply, QuickReplyItem,
     MessageAction
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
+from router import HashRing      # the ring router.py routes on
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
 app  = Flask(__name__)
-configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"),
+                              host=os.getenv("LINE_API_HOST"))   # unset → api.line.me
 handler       = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
 
+# ── LINE API connection pool ─────────────────────────────────────────
+# One ApiClient per worker process: its urllib3 pool keeps TLS connections
+# to api.line.me alive between replies and is safe to share across greenlets.
+configuration.connection_pool_maxsize = int(os.getenv("LINE_POOL_SIZE", 10))
+configuration.retries = urllib3.Retry(
+    total=int(os.getenv("LINE_RETRIES", 2)),
+    backoff_factor=float(os.getenv("LINE_RETRY_BACKOFF", 0.3)),
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=None,                  # reply is a POST; a replayed token just fails
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+LINE_TIMEOUT = (float(os.getenv("LINE_CONNECT_TIMEOUT", 3)),
+                float(os.getenv("LINE_READ_TIMEOUT", 10)))
+
+_api      = None
+_api_pid  = None
+_api_lock = threading.Lock()
+
+def line_api():
+    """The worker's shared MessagingApi, created on first use after fork."""
+    global _api, _api_pid
+    if _api is None or _api_pid != os.getpid():
+        with _api_lock:
+            if _api is None or _api_pid != os.getpid():
+                _api     = MessagingApi(ApiClient(configuration))
+                _api_pid = os.getpid()
+    return _api
+
 # ═══════════════════════════ THEME ═══════════════════════════════════
 # Black / White / Grey — elegant, unified, easy on the eyes
 C = {
@@ -34,27 +69,846 @@ C = {
     'btn_dark': '#212121',   # dark / black button
 }
 
+# ═══════════════════════════ ROTATION ════════════════════════════════
+ROTATION_KEYS = ["سؤال","تحدي","اعتراف","منشن","موقف","اقتباس","لغز","دين",
+                 "قصة","فلسفة","لو كنت","أيهما أصعب","أنا لم","تحفيز"]
+ROTATION_SLOT = {k: i for i, k in enumerate(ROTATION_KEYS)}
+
+def permute(i, n, seed):
+    """Map cursor i to the i-th element of a seeded permutation of range(n).
+    A 4-round Feistel network over the next even power of two, cycle-walked
+    back into range, so a pass needs no stored permutation — just the seed."""
+    half = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    while True:
+        l, r = i >> half, i & mask
+        for k in range(4):
+            h = ((r ^ seed ^ (k * 0x9E3779B9)) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            l, r = r, l ^ ((h >> 32) & mask)
+        i = (l << half) | r
+        if i < n: return i
+
+class Shards:
+    """Per-key mutable state split over `n` LRU maps, each behind its own lock
+    and holding up to `cap` keys. Threads (or greenlets) working on different
+    keys rarely share a lock; work on one key is serialized by its shard's."""
+
+    def __init__(self, max_keys, n=16):
+        self.cap  = max(1, -(-max_keys // n))
+        self.maps = [(threading.Lock(), OrderedDict()) for _ in range(n)]
+
+    def __len__(self): return sum(len(m) for _, m in self.maps)
+
+    def of(self, key):
+        """(lock, map) of the shard holding `key`."""
+        return self.maps[hash(key) % len(self.maps)]
+
+class RotationStore:
+    """Per-chat no-repeat rotation. Each chat keeps one array('I'):
+    [last_seen, seed0, cursor0, seed1, cursor1, ...] — one pair per category.
+    Chats are kept in LRU order and evicted past `max_chats` or after `ttl`
+    seconds idle, so memory stays bounded however many groups the bot is in.
+    A draw holds its chat's shard lock, so concurrent draws in one chat
+    never take the same cursor."""
+
+    def __init__(self, max_chats=50000, ttl=7 * 86400, shards=16):
+        self.max_chats = max_chats
+        self.ttl       = ttl
+        self.chats     = Shards(max_chats, shards)
+        self.changed   = None        # deque of changed chats, when journaled
+
+    def __len__(self): return len(self.chats)
+
+    def _state(self, chats, chat):
+        now = int(time.time())
+        st  = chats.get(chat)
+        if st is None:
+            st = chats[chat] = array('I', [0] * (1 + 2 * len(ROTATION_KEYS)))
+        else:
+            chats.move_to_end(chat)
+        st[0] = now
+        self._evict(chats, now)
+        return st
+
+    def _evict(self, chats, now):
+        while len(chats) > self.chats.cap:
+            chats.popitem(last=False)
+        while chats:
+            oldest = next(iter(chats.values()))
+            if now - oldest[0] <= self.ttl: break
+            chats.popitem(last=False)
+
+    def draw(self, chat, key, n):
+        lock, chats = self.chats.of(chat)
+        with lock:
+            st = self._state(chats, chat)
+            s  = 1 + 2 * ROTATION_SLOT[key]
+            if st[s] == 0 or st[s + 1] >= n:    # new pass → fresh seed
+                st[s], st[s + 1] = random.getrandbits(32) | 1, 0
+            idx = permute(st[s + 1], n, st[s])
+            st[s + 1] += 1
+        if self.changed is not None: self.changed.append(chat)
+        return idx
+
+    def draw_many(self, chat, key, n, k):
+        """The chat's next min(k, n) indices, all different (a batch that runs
+        into a new pass skips what it already holds)."""
+        lock, chats = self.chats.of(chat)
+        out, seen = [], set()
+        with lock:
+            st = self._state(chats, chat)
+            s  = 1 + 2 * ROTATION_SLOT[key]
+            while len(out) < min(k, n):
+                if st[s] == 0 or st[s + 1] >= n:
+                    st[s], st[s + 1] = random.getrandbits(32) | 1, 0
+                idx = permute(st[s + 1], n, st[s])
+                st[s + 1] += 1
+                if idx not in seen: seen.add(idx); out.append(idx)
+        if self.changed is not None: self.changed.append(chat)
+        return out
+
+    def drop(self, gone, chunk=256):
+        """Remove the chats `gone(chat)` picks, without journaling it (their
+        saved state stays for whoever holds them next), yielding every
+        `chunk` chats; returns how many went."""
+        n = 0
+        for lock, chats in self.chats.maps:
+            with lock: ids = list(chats)
+            for i in range(0, len(ids), chunk):
+                out = [c for c in ids[i:i + chunk] if gone(c)]
+                with lock:
+                    for c in out: chats.pop(c, None)
+                n += len(out)
+                time.sleep(0)
+        return n
+
+    def dump(self, chat):
+        """(last_seen, packed state) of `chat`, or None."""
+        lock, chats = self.chats.of(chat)
+        with lock:
+            st = chats.get(chat)
+            return None if st is None else (st[0], st.tobytes())
+
+    def load(self, chat, blob):
+        """Install a state saved by dump() as the chat's most recent."""
+        st = array('I'); st.frombytes(blob)
+        lock, chats = self.chats.of(chat)
+        with lock:
+            chats[chat] = st
+            chats.move_to_end(chat)
+            self._evict(chats, int(time.time()))
+
+# ═══════════════════════════ SESSIONS ════════════════════════════════
+class SessionStore(ABC):
+    """In-progress game/riddle/deen state, keyed "<kind>:<user_id>".
+    Values are small JSON-able dicts. A value read from the store is a copy as
+    far as callers are concerned: changes must be written back with set() or
+    made inside update(), which is the atomic read-modify-write."""
+
+    def __init__(self, ttl=6 * 3600):
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    @abstractmethod
+    def get_many(self, keys): ...
+    @abstractmethod
+    def set_many(self, items, ttl=None): ...
+    @abstractmethod
+    def delete(self, key): ...
+    @abstractmethod
+    def sweep(self): ...
+    @abstractmethod
+    def stats(self): ...
+    @abstractmethod
+    def update(self, key, fn, ttl=None):
+        """Store fn(current value or None) and return it; None deletes."""
+
+class _Session:
+    __slots__ = ("expires", "value")
+    def __init__(self, expires, value):
+        self.expires, self.value = expires, value
+
+class MemorySessionStore(SessionStore):
+    """Per-process store; each gunicorn worker has its own.
+    Entries are kept in LRU order and bounded by `max_entries`; expired ones are
+    dropped when read and by a full sweep at most every `sweep_every` seconds."""
+
+    def __init__(self, ttl=6 * 3600, max_entries=100000, sweep_every=300):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self.sweep_every = sweep_every
+        self.data        = OrderedDict()         # key → _Session
+        self.lock        = threading.Lock()
+        self.next_sweep  = time.time() + sweep_every
+        self.expired     = 0
+        self.evicted     = 0
+        self.changed     = None      # deque of changed keys, when journaled
+
+    def __len__(self): return len(self.data)
+
+    def _live(self, key, now):
+        e = self.data.get(key)
+        if e is None: return None
+        if e.expires <= now:
+            del self.data[key]
+            self.expired += 1
+            return None
+        self.data.move_to_end(key)
+        return e.value
+
+    def _put(self, key, value, exp):
+        data = self.data
+        if self.changed is not None: self.changed.append(key)
+        e = data.get(key)
+        if e is None:
+            data[key] = _Session(exp, value)
+            while len(data) > self.max_entries:
+                data.popitem(last=False)
+                self.evicted += 1
+        else:
+            e.expires, e.value = exp, value
+            data.move_to_end(key)
+
+    def get_many(self, keys):
+        now = time.time()
+        with self.lock:
+            return [self._live(k, now) for k in keys]
+
+    def set_many(self, items, ttl=None):
+        now = time.time()
+        exp = now + (ttl or self.ttl)
+        with self.lock:
+            for k, v in items.items(): self._put(k, v, exp)
+        if now >= self.next_sweep: self.sweep()
+
+    def delete(self, key):
+        with self.lock:
+            if self.data.pop(key, None) is not None and self.changed is not None:
+                self.changed.append(key)
+
+    def update(self, key, fn, ttl=None):
+        now = time.time()
+        with self.lock:
+            v = fn(self._live(key, now))
+            if v is None:
+                if self.data.pop(key, None) is not None and self.changed is not None:
+                    self.changed.append(key)
+            else: self._put(key, v, now + (ttl or self.ttl))
+            return v
+
+    def sweep(self):
+        """Drop every expired entry; returns how many were dropped."""
+        now = time.time()
+        with self.lock:
+            self.next_sweep = now + self.sweep_every
+            dead = [k for k, e in self.data.items() if e.expires <= now]
+            for k in dead: del self.data[k]
+            self.expired += len(dead)
+        return len(dead)
+
+    def stats(self):
+        return {"size": len(self.data), "max": self.max_entries,
+                "expired": self.expired, "evicted": self.evicted}
+
+class SQLiteSessionStore(SessionStore):
+    """Store shared by every worker on the host through one SQLite file in WAL
+    mode. update() runs inside BEGIN IMMEDIATE, so concurrent read-modify-writes
+    from different workers serialize on the database write lock."""
+
+    def __init__(self, path, ttl=6 * 3600):
+        super().__init__(ttl)
+        self.path    = path
+        self.db      = None
+        self.pid     = None
+        self.lock    = threading.Lock()
+        self.writes  = 0
+        self.expired = 0
+
+    def _conn(self):
+        if self.db is None or self.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                       "k TEXT PRIMARY KEY, v TEXT NOT NULL, expires REAL NOT NULL)")
+            self.db, self.pid = db, os.getpid()
+        return self.db
+
+    def __len__(self):
+        with self.lock:
+            return self._conn().execute(
+                "SELECT COUNT(*) FROM sessions WHERE expires > ?", (time.time(),)).fetchone()[0]
+
+    def get_many(self, keys):
+        with self.lock:
+            rows = self._conn().execute(
+                f"SELECT k, v FROM sessions WHERE expires > ? AND k IN ({','.join('?' * len(keys))})",
+                (time.time(), *keys)).fetchall()
+        found = {k: json.loads(v) for k, v in rows}
+        return [found.get(k) for k in keys]
+
+    def _put(self, db, items, ttl):
+        exp = time.time() + (ttl or self.ttl)
+        db.executemany("INSERT OR REPLACE INTO sessions (k, v, expires) VALUES (?, ?, ?)",
+                       [(k, json.dumps(v, ensure_ascii=False), exp) for k, v in items.items()])
+        self.writes += 1
+        if self.writes % 1024 == 0:      # expired rows are ignored by reads; this reclaims them
+            self.expired += db.execute("DELETE FROM sessions WHERE expires <= ?",
+                                       (time.time(),)).rowcount
+
+    def _tx(self, fn):
+        """Run fn(db) in one write transaction, holding the file's write lock."""
+        with self.lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                r = fn(db)
+                db.execute("COMMIT")
+                return r
+            except BaseException:
+                db.execute("ROLLBACK"); raise
+
+    def set_many(self, items, ttl=None):
+        self._tx(lambda db: self._put(db, items, ttl))
+
+    def delete(self, key):
+        with self.lock:
+            self._conn().execute("DELETE FROM sessions WHERE k = ?", (key,))
+
+    def update(self, key, fn, ttl=None):
+        def rmw(db):
+            row = db.execute("SELECT v FROM sessions WHERE k = ? AND expires > ?",
+                             (key, time.time())).fetchone()
+            v = fn(json.loads(row[0]) if row else None)
+            if v is None: db.execute("DELETE FROM sessions WHERE k = ?", (key,))
+            else: self._put(db, {key: v}, ttl)
+            return v
+        return self._tx(rmw)
+
+    def sweep(self):
+        n = self._tx(lambda db: db.execute("DELETE FROM sessions WHERE expires <= ?",
+                                           (time.time(),)).rowcount)
+        self.expired += n
+        return n
+
+    def stats(self):
+        return {"size": len(self), "expired": self.expired}
+
+def make_session_store():
+    """SESSION_STORE=memory (default) or sqlite:///path/to/sessions.db"""
+    url = os.getenv("SESSION_STORE", "memory")
+    ttl = int(os.getenv("SESSION_TTL", 6 * 3600))
+    if url.startswith("sqlite:///"):
+        return SQLiteSessionStore(url[len("sqlite:///"):], ttl=ttl)
+    return MemorySessionStore(ttl=ttl,
+                              max_entries=int(os.getenv("SESSION_MAX", 100000)),
+                              sweep_every=int(os.getenv("SESSION_SWEEP", 300)))
+
+# ═══════════════════════════ PERSISTENCE ═════════════════════════════
+def off_loop(fn, *args):
+    """fn(*args) on a real OS thread when gevent has patched threading, so a
+    blocking call (SQLite's commit and busy wait) doesn't stall the worker's
+    event loop; a plain call otherwise. fn must not take gevent locks."""
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is None or not monkey.is_module_patched("threading"): return fn(*args)
+    import gevent
+    def call():
+        try: return fn(*args), None
+        except Exception as e: return None, e       # raised here, not logged by the pool
+    out, err = gevent.get_hub().threadpool.apply(call)
+    if err is not None: raise err
+    return out
+
+class StateJournal:
+    """Write-behind copy of a worker's rotation and memory-session state in one
+    SQLite file (WAL), shared by the workers on the host, so a restart or
+    deploy resumes where the chats left off.
+    A change only appends its key to the store's `changed` deque; a background
+    job writes the latest value of every changed key once per `every`
+    seconds, in one transaction run off the event loop. Requests never wait
+    on the disk, and a key changed many times between flushes costs one row
+    write. Keys of a failed flush are queued again for the next one."""
+
+    def __init__(self, path, rotation, sessions=None, every=1.0):
+        self.path, self.rotation, self.sessions, self.every = path, rotation, sessions, every
+        self.db      = None
+        self.pid     = None
+        self.lock    = threading.Lock()
+        self.stats   = {"changes": 0, "rows": 0, "flushes": 0, "flush_secs": 0.0,
+                        "restored": 0, "restore_secs": 0.0}
+        rotation.changed = deque()
+        if sessions is not None: sessions.changed = deque()
+
+    def _conn(self):
+        if self.db is None or self.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS rotation_state ("
+                       "chat TEXT PRIMARY KEY, seen INTEGER NOT NULL, st BLOB NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS session_state ("
+                       "k TEXT PRIMARY KEY, v TEXT NOT NULL, expires REAL NOT NULL)")
+            self.db, self.pid = db, os.getpid()
+        return self.db
+
+    @staticmethod
+    def _drain(q):
+        return {q.popleft() for _ in range(len(q))}
+
+    def flush(self):
+        """Write out everything changed since the last flush; returns the row count."""
+        with self.lock:
+            t0, rot, ses = time.perf_counter(), self.rotation, self.sessions
+            n0 = len(rot.changed) + (len(ses.changed) if ses else 0)
+            chats = self._drain(rot.changed)
+            keys  = self._drain(ses.changed) if ses else ()
+            if not chats and not keys: return 0
+            r_put, r_del = [], []
+            for chat in chats:
+                st = rot.dump(chat)
+                if st is None: r_del.append((chat,))
+                else: r_put.append((chat, *st))
+            s_put, s_del = [], []
+            if keys:
+                with ses.lock:
+                    for k in keys:
+                        e = ses.data.get(k)
+                        if e is None: s_del.append((k,))
+                        else: s_put.append((k, json.dumps(e.value, ensure_ascii=False), e.expires))
+            try:
+                off_loop(self._write, r_put, r_del, s_put, s_del)
+            except BaseException:
+                rot.changed.extend(chats)
+                if keys: ses.changed.extend(keys)
+                raise
+            rows = len(chats) + len(keys)
+            st = self.stats
+            st["changes"] += n0; st["rows"] += rows; st["flushes"] += 1
+            st["flush_secs"] += time.perf_counter() - t0
+            return rows
+
+    def _write(self, r_put, r_del, s_put, s_del):
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT OR REPLACE INTO rotation_state VALUES (?, ?, ?)", r_put)
+            db.executemany("DELETE FROM rotation_state WHERE chat = ?", r_del)
+            db.executemany("INSERT OR REPLACE INTO session_state VALUES (?, ?, ?)", s_put)
+            db.executemany("DELETE FROM session_state WHERE k = ?", s_del)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK"); raise
+
+    def restore(self):
+        """Load the saved state into the (empty) stores, dropping what has
+        expired; returns the number of chats and sessions loaded."""
+        t0, now, rot, ses = time.perf_counter(), time.time(), self.rotation, self.sessions
+        db = self._conn()
+        db.execute("DELETE FROM rotation_state WHERE seen <= ?", (int(now) - rot.ttl,))
+        size, n = 4 * (1 + 2 * len(ROTATION_KEYS)), 0
+        rows = db.execute("SELECT chat, st FROM rotation_state ORDER BY seen DESC LIMIT ?",
+                          (rot.max_chats,)).fetchall()
+        for chat, blob in reversed(rows):           # oldest first: LRU order
+            if len(blob) != size: continue          # saved with a different category list
+            rot.load(chat, blob); n += 1
+        if ses is not None:
+            db.execute("DELETE FROM session_state WHERE expires <= ?", (now,))
+            rows = db.execute("SELECT k, v, expires FROM session_state ORDER BY expires DESC LIMIT ?",
+                              (ses.max_entries,)).fetchall()
+            with ses.lock:
+                for k, v, exp in reversed(rows):
+                    ses.data[k] = _Session(exp, json.loads(v)); n += 1
+        self.stats["restored"] = n
+        self.stats["restore_secs"] = time.perf_counter() - t0
+        return n
+
+    def restore_where(self, want, chunk=256):
+        """Load the saved chats `want(chat)` picks that the store doesn't hold,
+        and the saved sessions it lacks (those are keyed by user, not chat),
+        `chunk` rows at a time with a yield in between; returns the number loaded."""
+        now, rot, ses, n = time.time(), self.rotation, self.sessions, 0
+        size = 4 * (1 + 2 * len(ROTATION_KEYS))
+        for rows in self._chunks("SELECT rowid, chat, st FROM rotation_state "
+                                 "WHERE rowid > ? AND seen > ? ORDER BY rowid LIMIT ?", int(now) - rot.ttl, chunk):
+            for _, chat, blob in rows:
+                if len(blob) == size and want(chat) and rot.dump(chat) is None:
+                    rot.load(chat, blob); n += 1
+        if ses is not None:
+            for rows in self._chunks("SELECT rowid, k, v, expires FROM session_state "
+                                     "WHERE rowid > ? AND expires > ? ORDER BY rowid LIMIT ?", now, chunk):
+                with ses.lock:
+                    for _, k, v, exp in rows:
+                        if k not in ses.data:
+                            ses.data[k] = _Session(exp, json.loads(v)); n += 1
+        return n
+
+    def _chunks(self, sql, bound, chunk):
+        last = 0
+        while True:
+            with self.lock: rows = self._conn().execute(sql, (last, bound, chunk)).fetchall()
+            if not rows: return
+            yield rows
+            last = rows[-1][0]
+            time.sleep(0)
+
+    def snapshot(self):
+        st = self.stats
+        return {**st, "write_amplification": round(st["rows"] / st["changes"], 3) if st["changes"] else None}
+
+def make_journal(rotation, sessions):
+    """STATE_DB=path/to/state.db (default state.db; empty disables). Memory
+    sessions are journaled with the rotation; a SQLite session store already
+    persists itself."""
+    path = os.getenv("STATE_DB", "state.db")
+    if not path: return None
+    j = StateJournal(path, rotation, sessions if isinstance(sessions, MemorySessionStore) else None,
+                     every=float(os.getenv("STATE_FLUSH_EVERY", 1)))
+    try:
+        n = j.restore()
+        logger.info(f"restored {n} chats/sessions from {path} in {j.stats['restore_secs'] * 1e3:.1f} ms")
+    except sqlite3.Error as e:
+        logger.error(f"{path}: {e}; starting without saved state")
+    return j
+
+# ═══════════════════════════ SEARCH ══════════════════════════════════
+# Inverted index over the content, per category: normalized term → array of
+# item indices. Built with each content snapshot; unchanged categories keep
+# their postings across reloads.
+_AR_FOLD = str.maketrans({
+    **{c: "ا" for c in "أإآٱ"}, "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي",
+    **{c: None for c in "\u0640\u064B\u064C\u064D\u064E\u064F\u0650\u0651\u0652\u0670"},
+})
+_AR_PREFIXES = ("وال", "بال", "فال", "كال", "لل", "ال")
+
+def normalize_ar(text):
+    """Fold hamza/alef, ya and ta marbuta; drop tatweel and diacritics; collapse spaces."""
+    return " ".join(text.translate(_AR_FOLD).lower().split())
+
+_NON_WORD = re.compile(r"[^\w\s\u064B-\u0652\u0670]+")   # keeps diacritics for _AR_FOLD
+
+def command_key(text, heads=None):
+    """The form commands are matched in: normalize_ar() without punctuation or
+    emoji. With `heads`, None unless the first word is one of them, which
+    skips folding the rest of ordinary chatter."""
+    words = _NON_WORD.sub(" ", text).split()
+    if not words: return None
+    if heads is not None and words[0].translate(_AR_FOLD).lower() not in heads: return None
+    return " ".join(" ".join(words).translate(_AR_FOLD).lower().split())
+
+def search_terms(text):
+    """Index terms of `text`: normalized words with a leading article stripped."""
+    terms = set()
+    for w in re.findall(r"\w+", normalize_ar(text)):
+        for p in _AR_PREFIXES:
+            if w.startswith(p) and len(w) - len(p) >= 2:
+                w = w[len(p):]; break
+        terms.add(w)
+    return terms
+
+def item_text(item):
+    if isinstance(item, QA): return item.question
+    if isinstance(item, dict): return f"{item.get('text', '')} {item.get('author', '')}"
+    return item if isinstance(item, str) else ""
+
+def build_index(items):
+    post = {}
+    for i, item in enumerate(items):
+        for term in search_terms(item_text(item)):
+            post.setdefault(term, array('I')).append(i)
+    return post
+
+class SearchIndex(dict):
+    """category → postings, built on first lookup so startup stays cheap."""
+
+    def __init__(self, content, carried=()):
+        super().__init__(carried)
+        self.content = content
+
+    def __missing__(self, cat):
+        post = self[cat] = build_index(getattr(self.content, SEARCH_FIELDS[cat]))
+        return post
+
+def lookup(post, query):
+    """Indices of the items holding every term of `query`, or None for an empty query."""
+    terms = search_terms(query)
+    if not terms: return None
+    lists = sorted((post.get(t, ()) for t in terms), key=len)
+    hits  = set(lists[0])
+    for l in lists[1:]:
+        if not hits: break
+        hits.intersection_update(l)
+    return hits
+
+SEARCH_FIELDS = {   # category (its command) → content field
+    "سؤال": "questions", "تحدي": "challenges", "اعتراف": "confessions",
+    "منشن": "mention", "موقف": "situations", "اقتباس": "quotes",
+    "لغز": "riddles", "دين": "religion", "قصة": "stories",
+    "فلسفة": "philosophy", "لو كنت": "scenarios", "أيهما أصعب": "choices",
+    "أنا لم": "never", "تحفيز": "motivation",
+}
+
 # ═══════════════════════════ CONTENT MANAGER ═════════════════════════
+class QA:
+    """One riddle or religion question."""
+    __slots__ = ("question", "answer", "hint")
+
+    def __init__(self, question, answer, hint="لا يوجد تلميح"):
+        self.question, self.answer, self.hint = question, answer, hint
+
+    @classmethod
+    def load(cls, items):
+        return [cls(d["question"], d["answer"], d.get("hint", "لا يوجد تلميح"))
+                for d in items if isinstance(d, dict) and "question" in d and "answer" in d]
+
+class Game:
+    """One personality game compiled for play. Progress is a single int of
+    `bits`-wide fields:  q | score_0 << 1·bits | first_0 << 2·bits | score_1 ...
+    with one (score, first) pair per result, where first is 1 + the question at
+    which the result first scored. An answer is a few shifts and adds, and the
+    winner — highest score, ties to the result that scored first — is read off
+    the fields whatever the game's length.
+    An option is its text, which scores 1 for the result of its own key, or
+    {"text": ..., "weight": n} / {"text": ..., "scores": {result key: n, ...}}."""
+    __slots__ = ("title", "questions", "options", "keys", "results", "bits", "messages")
+    FALLBACK = "شخصيتك مميزة ومختلفة"
+
+    def __init__(self, raw, results):
+        self.title, self.questions, scored = raw.get("title", "تحليل"), [], []
+        keys = {}                                    # result key → slot, first-seen order
+        for q in raw.get("questions", []):
+            opts, sc = {}, {}
+            for k, v in q.get("options", {}).items():
+                if isinstance(v, dict):
+                    opts[k] = v.get("text", "")
+                    sc[k] = v.get("scores") or {k: v.get("weight", 1)}
+                else:
+                    opts[k], sc[k] = v, {k: 1}
+                for r in sc[k]: keys.setdefault(r, len(keys))
+            self.questions.append({"question": q.get("question", ""), "options": opts})
+            scored.append(sc)
+        n = len(self.questions)
+        top = [0] * len(keys)                        # highest reachable score per result
+        for sc in scored:
+            for r, slot in keys.items():
+                top[slot] += max((max(0, int(w.get(r, 0))) for w in sc.values()), default=0)
+        b = self.bits = max(1, n.bit_length(), *(t.bit_length() for t in top))
+        self.options = [{k: tuple(((2 * keys[r] + 1) * b, max(0, int(w))) for r, w in ws.items())
+                         for k, ws in sc.items()} for sc in scored]
+        self.keys    = tuple(keys)
+        self.results = tuple(results.get(k, self.FALLBACK) for k in keys)
+        self.messages = [None] * n                   # question Flex messages, built on first use
+
+    @classmethod
+    def load(cls, games, results):
+        return [cls(g, results.get(f"لعبة{i + 1}", {})) for i, g in enumerate(games)]
+
+    def step(self, p):
+        return p & ((1 << self.bits) - 1)
+
+    def done(self, p):
+        return self.step(p) >= len(self.questions)
+
+    def answer(self, p, key):
+        """Progress after answering the current question with option `key`;
+        None when `key` is not one of its options."""
+        b, mask = self.bits, (1 << self.bits) - 1
+        q = p & mask
+        opt = self.options[q].get(key) if q < len(self.options) else None
+        if opt is None: return None
+        for shift, w in opt:
+            if not w: continue
+            p += w << shift
+            if not (p >> (shift + b)) & mask: p |= (q + 1) << (shift + b)
+        return p + 1
+
+    def replay(self, answers):
+        p = 0
+        for a in answers: p = self.answer(p, a) or p
+        return p
+
+    def result(self, p):
+        b, mask, best, win = self.bits, (1 << self.bits) - 1, (0, 0), None
+        for slot in range(len(self.keys)):
+            f = p >> ((2 * slot + 1) * b)
+            score, first = f & mask, (f >> b) & mask
+            if first and (score, -first) > best: best, win = (score, -first), slot
+        return self.FALLBACK if win is None else self.results[win]
+
+    def message(self, q):
+        m = self.messages[q]
+        if m is None:
+            m = self.messages[q] = Wire.of(question_flex(self.title, self.questions[q],
+                                                         f"{q + 1}/{len(self.questions)}"))
+        return m
+
+class Content:
+    """One snapshot of every content file. It is never mutated once built: a
+    reload builds a new one and swaps it in with a single assignment, so a
+    reader that took the old snapshot keeps a consistent view."""
+
+    def __init__(self, old=None, stale=(), **fields):
+        self.__dict__.update(fields)
+        # search postings; those of unchanged fields carry over from `old`
+        self.index = SearchIndex(self, () if old is None else
+                                 ((c, p) for c, p in old.index.items()
+                                  if SEARCH_FIELDS[c] not in stale))
+        self.files = {"سؤال": self.questions, "تحدي": self.challenges,
+                      "اعتراف": self.confessions}
+        self.game_models = Game.load(self.games, self.results)
+
+# ── Snapshot file ────────────────────────────────────────────────────
+# Every source compiled into one file that workers mmap, so the page cache
+# holds a single copy of the text for the whole host:
+#   b"NAESNAP" version:u8 | header_len:u32 | header JSON | offset tables (u32) | UTF-8 blob
+# The header maps each field to its kind, table position and item count,
+# records the blob's start, the file size and the blob's CRC-32, and the
+# source mtimes so stale fields are re-parsed from the files.
+SNAPSHOT_MAGIC   = b"NAESNAP"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_PATH    = os.getenv("CONTENT_SNAPSHOT", "content.snap")
+
+def _decode_qa(b):
+    return QA(*json.loads(b))
+
+SNAPSHOT_DECODE = {"str": lambda b: str(b, "utf-8"), "json": json.loads, "qa": _decode_qa}
+SNAPSHOT_ENCODE = {
+    "str":  lambda x: x,
+    "json": lambda x: json.dumps(x, ensure_ascii=False),
+    "qa":   lambda x: json.dumps([x.question, x.answer, x.hint], ensure_ascii=False),
+}
+
+class PackedList:
+    """Read-only sequence over one field of a mapped snapshot file.
+    Items are decoded from the mapping each time they are read."""
+    __slots__ = ("mm", "offs", "decode")
+
+    def __init__(self, mm, offs, decode):
+        self.mm, self.offs, self.decode = mm, offs, decode
+
+    def __len__(self): return len(self.offs) - 1
+
+    def __getitem__(self, i):
+        if i < 0: i += len(self.offs) - 1
+        o = self.offs
+        return self.decode(self.mm[o[i]:o[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+def write_snapshot(path=None):
+    """Parse every content source and write it as one snapshot file."""
+    path = path or SNAPSHOT_PATH
+    loader, header, items = ContentManager(), {"mtimes": {}, "fields": {}}, []
+    for name, (f, parse, kind) in ContentManager.SOURCES.items():
+        header["mtimes"][f] = loader._mtime(f)
+        value = getattr(loader, parse)(f)
+        enc   = [json.dumps(value, ensure_ascii=False)] if kind == "value" else \
+                [SNAPSHOT_ENCODE[kind](x) for x in value]
+        header["fields"][name] = [kind, len(enc)]
+        items.append([x.encode("utf-8") for x in enc])
+    n_offs = sum(len(enc) + 1 for enc in items)
+    crc = 0
+    for enc in items:
+        for b in enc: crc = zlib.crc32(b, crc)
+    header["crc"] = crc
+    # table positions depend on the header length, which depends on them:
+    # repeat until the header stops changing
+    head = b""
+    while True:
+        pos  = (len(SNAPSHOT_MAGIC) + 5 + len(head) + 3) & ~3
+        blob = pos + 4 * n_offs
+        offs = array('I')
+        for name, enc in zip(header["fields"], items):
+            header["fields"][name][2:] = [pos + 4 * len(offs)]
+            offs.append(blob)
+            for b in enc:
+                blob += len(b); offs.append(blob)
+        header["blob"], header["size"] = pos + 4 * n_offs, blob
+        new = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        if new == head: break
+        head = new
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + len(head).to_bytes(4, "little") + head)
+        fh.write(b"\0" * (pos - fh.tell()))
+        fh.write(offs.tobytes())
+        for enc in items: fh.writelines(enc)
+    os.replace(tmp, path)       # workers that mapped the old file keep it
+    return path
+
+def open_snapshot(path):
+    """(fields, mtimes) from a snapshot file, or None if there is no usable one."""
+    try:
+        with open(path, "rb") as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    m = len(SNAPSHOT_MAGIC)
+    if len(mm) < m + 5 or mm[:m] != SNAPSHOT_MAGIC or mm[m] != SNAPSHOT_VERSION:
+        logger.warning(f"{path}: not a version {SNAPSHOT_VERSION} content snapshot, ignoring")
+        return None
+    try:
+        hlen   = int.from_bytes(mm[m + 1:m + 5], "little")
+        header = json.loads(mm[m + 5:m + 5 + hlen])
+        start, size = header["blob"], header["size"]
+        if size != len(mm): raise ValueError(f"{len(mm)} bytes, header says {size}")
+        if not m + 5 + hlen <= start <= size: raise ValueError("blob out of bounds")
+        if zlib.crc32(mm[start:size]) != header["crc"]: raise ValueError("CRC mismatch")
+        view, fields = memoryview(mm), {}
+        for name, (kind, count, pos) in header["fields"].items():
+            if not m + 5 + hlen <= pos <= pos + 4 * (count + 1) <= start:
+                raise ValueError(f"{name}: offset table out of bounds")
+            offs = view[pos:pos + 4 * (count + 1)].cast('I')
+            if offs[0] < start or any(a > b for a, b in zip(offs, offs[1:])) or offs[-1] > size:
+                raise ValueError(f"{name}: offsets out of bounds")
+            fields[name] = json.loads(mm[offs[0]:offs[1]]) if kind == "value" else \
+                           PackedList(mm, offs, SNAPSHOT_DECODE[kind])
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        logger.error(f"{path}: unreadable content snapshot, ignoring: {e}")
+        return None
+    return fields, header["mtimes"]
+
 class ContentManager:
+    SOURCES = {   # snapshot field → (file, parser, how it is packed in a snapshot file)
+        "questions":  ("questions.txt",                "_lines",      "str"),
+        "challenges": ("challenges.txt",               "_lines",      "str"),
+        "confessions":("confessions.txt",              "_lines",      "str"),
+        "mention":    ("more_questions.txt",           "_lines",      "str"),
+        "situations": ("situations.txt",               "_lines",      "str"),
+        "quotes":     ("quotes.txt",                   "_quotes",     "json"),
+        "riddles":    ("riddles.json",                 "_qa",         "qa"),
+        "results":    ("detailed_results.json",        "_json",       "value"),
+        "religion":   ("religion.json",                "_qa",         "qa"),
+        "stories":    ("stories.txt",                  "_stories",    "str"),
+        "scenarios":  ("scenarios.txt",                "_lines",      "str"),
+        "choices":    ("choices.txt",                  "_lines",      "str"),
+        "never":      ("never.txt",                    "_lines",      "str"),
+        "motivation": ("motivation.txt",               "_lines",      "str"),
+        "games":      ("personality_games.json",       "_games",      "value"),
+        "philosophy": ("philosophical_questions.json", "_philosophy", "str"),
+    }
+
     def __init__(self):
-        self.files      = {}
-        self.mention    = []
-        self.games      = []
-        self.quotes     = []
-        self.situations = []
-        self.riddles    = []
-        self.results    = {}
-        self.religion   = []
-        self.stories    = []
-        self.scenarios  = []
-        self.choices    = []
-        self.never      = []
-        self.motivation = []
-        self.philosophy = []
-        self.used        = {}
-        self.game_state  = {}
-        self.riddle_state= {}
-        self.deen_state  = {}
+        self.snap        = None
+        self.mtimes      = {}
+        self.reload_lock = threading.Lock()
+        self.used        = RotationStore(
+            max_chats=int(os.getenv("ROTATION_MAX_CHATS", 50000)),
+            ttl=int(os.getenv("ROTATION_TTL", 7 * 86400)))
+        self.sessions    = make_session_store()
+
+    def __getattr__(self, name):
+        # cm.riddles, cm.files, ... read the current snapshot
+        snap = self.__dict__.get("snap")
+        if snap is None: raise AttributeError(name)
+        return getattr(snap, name)
 
     def _lines(self, f):
         if not os.path.exists(f): logger.warning(f"Missing: {f}"); return []
@@ -119,63 +973,209 @@ class ContentManager:
         except Exception as e:
             logger.error(f"{f}: {e}"); return []
 
+    def _qa(self, f):
+        return QA.load(self._json(f, default=[]))
+
+    def _games(self, f):
+        raw = self._json(f)
+        return [raw[k] for k in sorted(raw.keys())] if isinstance(raw, dict) else []
+
+    def _philosophy(self, f):
+        phil = self._json(f, default=[])
+        return [p["question"] for p in phil if "question" in p]
+
+    @staticmethod
+    def _mtime(f):
+        try: return os.stat(f).st_mtime_ns
+        except OSError: return None
+
     def initialize(self):
-        self.files = {
-            "سؤال":   self._lines("questions.txt"),
-            "تحدي":   self._lines("challenges.txt"),
-            "اعتراف": self._lines("confessions.txt"),
-        }
-        self.mention    = self._lines("more_questions.txt")
-        self.situations = self._lines("situations.txt")
-        self.quotes     = self._quotes("quotes.txt")
-        self.riddles    = self._json("riddles.json", default=[])
-        self.results    = self._json("detailed_results.json")
-        self.religion   = self._json("religion.json", default=[])
-        self.stories    = self._stories("stories.txt")
-        self.scenarios  = self._lines("scenarios.txt")
-        self.choices    = self._lines("choices.txt")
-        self.never      = self._lines("never.txt")
-        self.motivation = self._lines("motivation.txt")
-
-        raw = self._json("personality_games.json")
-        self.games = [raw[k] for k in sorted(raw.keys())] if isinstance(raw, dict) else []
-
-        phil = self._json("philosophical_questions.json", default=[])
-        self.philosophy = [p["question"] for p in phil if "question" in p]
-
-        keys = ["سؤال","تحدي","اعتراف","منشن","موقف","اقتباس","لغز","دين",
-                "قصة","فلسفة","لو كنت","أيهما أصعب","أنا لم","تحفيز"]
-        self.used = {k: [] for k in keys}
-        logger.info(f"games={len(self.games)} riddles={len(self.riddles)} "
-                    f"religion={len(self.religion)} stories={len(self.stories)} "
-                    f"quotes={len(self.quotes)}")
-
-    def get_random(self, key, data):
-        if not data: return None
-        used = self.used.setdefault(key, [])
-        if len(used) >= len(data): used.clear()
-        avail = [i for i in range(len(data)) if i not in used]
-        idx = random.choice(avail)
-        used.append(idx)
-        return data[idx]
+        """Load from the snapshot file when there is one; fields whose source
+        changed since it was built are then re-parsed by reload()."""
+        packed = open_snapshot(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
+        if packed and set(packed[0]) == set(self.SOURCES):
+            self.snap, self.mtimes = Content(**packed[0]), packed[1]
+            logger.info(f"content snapshot: {SNAPSHOT_PATH}")
+            self.reload()
+        else:
+            self.reload(force=True)
+
+    def reload(self, force=False):
+        """Re-parse the files whose mtime changed since the last load and swap in
+        a new snapshot. Returns the changed file names. Requests already
+        running keep the snapshot they started with."""
+        with self.reload_lock:
+            old, fields, mtimes, changed, stale = self.snap, {}, {}, [], set()
+            for name, (f, parse, _) in self.SOURCES.items():
+                mtimes[f] = m = self._mtime(f)
+                if force or old is None or m != self.mtimes.get(f):
+                    fields[name] = getattr(self, parse)(f)
+                    changed.append(f); stale.add(name)
+                else:
+                    fields[name] = getattr(old, name)
+            if not changed: return []
+            self.snap, self.mtimes = Content(old, stale, **fields), mtimes
+        c = self.snap
+        logger.info(f"games={len(c.games)} riddles={len(c.riddles)} "
+                    f"religion={len(c.religion)} stories={len(c.stories)} "
+                    f"quotes={len(c.quotes)}")
+        return changed
+
+    def search(self, query, categories=None, limit=50):
+        """[(category, index, item)] of items matching every term of `query`."""
+        snap, out = self.snap, []
+        for cat in categories or SEARCH_FIELDS:
+            data = getattr(snap, SEARCH_FIELDS[cat])
+            for i in sorted(lookup(snap.index[cat], query) or ()):
+                if len(out) >= limit: return out
+                out.append((cat, i, data[i]))
+        return out
+
+    def draw_matching(self, key, query):
+        """(index, item) of a random item of category `key` matching `query`;
+        (None, None) when nothing matches."""
+        snap = self.snap
+        hits = lookup(snap.index[key], query)
+        if not hits: return None, None
+        idx = random.choice(tuple(hits))
+        return idx, getattr(snap, SEARCH_FIELDS[key])[idx]
+
+    def draw(self, key, data, chat=""):
+        """(index, item) of the chat's next item in `data`; (None, None) if empty."""
+        if not data: return None, None
+        idx = self.used.draw(chat, key, len(data))
+        return idx, data[idx]
+
+    def draw_many(self, key, data, chat, k):
+        """[(index, item)] of the chat's next k distinct items in `data`."""
+        if not data: return []
+        return [(i, data[i]) for i in self.used.draw_many(chat, key, len(data), k)]
+
+    def get_random(self, key, data, chat=""):
+        return self.draw(key, data, chat)[1]
 
 cm = ContentManager()
 cm.initialize()
+journal = make_journal(cm.used, cm.sessions)
+if journal is not None:
+    atexit.register(journal.flush)        # flushed periodically by the scheduler
+
+# ═══════════════════════════ PROFILING ═══════════════════════════════
+# Per-event timing marks. threading.local is per greenlet under gevent.
+turn = threading.local()
+
+# The slow-request trace and the sampler are both off by default; off, a
+# hook costs an attribute lookup.
+SLOW_MS = float(os.getenv("SLOW_REQUEST_MS", 0))      # log deliveries slower than this; 0 = off
+PHASES  = ("verify", "parse", "dispatch", "flex", "from_dict", "reply")   # reply: body + API call
+
+class Trace:
+    """Per-phase time of one webhook delivery. flex is the render step of
+    each command and includes from_dict, the validation of Flex dicts
+    into models that a payload cache miss pays."""
+    __slots__ = ("t0", "secs", "commands")
+
+    def __init__(self):
+        self.t0, self.secs, self.commands = time.perf_counter(), dict.fromkeys(PHASES, 0.0), []
+
+    def done(self):
+        total = time.perf_counter() - self.t0
+        if total * 1e3 < SLOW_MS: return
+        SLOW_N.inc()
+        s = self.secs
+        other = total - sum(v for k, v in s.items() if k != "from_dict")
+        logger.warning(f"slow delivery {total * 1e3:.1f} ms: " +
+                       " ".join(f"{k}={v * 1e3:.2f}" for k, v in s.items()) +
+                       f" other={other * 1e3:.2f} commands={','.join(self.commands) or '-'}")
+
+def traced(phase, t0):
+    """Charge the time since t0 to `phase` of the delivery being traced, if any."""
+    tr = getattr(turn, "trace", None)
+    if tr is not None: tr.secs[phase] += time.perf_counter() - t0
+
+def from_dict(d):
+    """FlexContainer.from_dict, timed for the trace."""
+    t = time.perf_counter()
+    c = FlexContainer.from_dict(d)
+    traced("from_dict", t)
+    return c
+
+class Sampler:
+    """In-process sampling profiler. Every `interval` seconds of CPU time
+    (ITIMER_PROF) the stack of each thread that is inside a webhook delivery
+    (callback or handle_delivery) is counted; everything else is skipped.
+    dump() gives the counts in the folded "root;...;leaf count" format that
+    flamegraph.pl and speedscope read. Per worker process: timers don't
+    survive fork, so start() runs in each worker."""
+
+    def __init__(self, hz, max_stacks=20000):
+        self.interval   = 1.0 / hz
+        self.max_stacks = max_stacks
+        self.stacks     = {}          # tuple of code objects, root first → samples
+        self.pid        = None
+        self.stats      = {"samples": 0, "outside": 0, "dropped": 0, "secs": 0.0}
+
+    def start(self):
+        if self.pid == os.getpid(): return
+        try:
+            signal.signal(signal.SIGPROF, self._sample)
+        except ValueError:            # not the main thread; the next start() may be
+            return
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.pid = os.getpid()
+
+    def _sample(self, signum, frame):
+        t0, me, roots = time.perf_counter(), sys._getframe(), PROFILE_ROOTS
+        for f in sys._current_frames().values():
+            stack, root = [], 0
+            while f is not None:                    # leaf to root; keep up to the outermost root
+                if f is not me:
+                    stack.append(f.f_code)
+                    if f.f_code in roots: root = len(stack)
+                f = f.f_back
+            if not root:
+                self.stats["outside"] += 1; continue
+            key = tuple(reversed(stack[:root]))
+            n = self.stacks.get(key)
+            if n is None and len(self.stacks) >= self.max_stacks:
+                self.stats["dropped"] += 1; continue
+            self.stacks[key] = (n or 0) + 1
+            self.stats["samples"] += 1
+        self.stats["secs"] += time.perf_counter() - t0     # the sampler's own cost
+
+    @staticmethod
+    def _name(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def dump(self, reset=False):
+        stacks = self.stacks
+        if reset: self.stacks = {}
+        return "".join(f"{';'.join(map(self._name, k))} {n}\n"
+                       for k, n in sorted(stacks.items(), key=lambda kv: -kv[1]))
+
+PROFILE_HZ = float(os.getenv("PROFILE_HZ", 0))        # samples per CPU second; 0 = off
+profiler   = Sampler(PROFILE_HZ) if PROFILE_HZ > 0 else None
 
 # ═══════════════════════════ MENUS ═══════════════════════════════════
+FLEX = {}   # static screens and template skeletons, see build_flex_cache()
+
 MENU_A = ["سؤال","منشن","اعتراف","تحدي","موقف","اقتباس",
           "تحليل","لغز","دين","قصة","فلسفة","لو كنت","المزيد"]
 MENU_B = ["أيهما أصعب","أنا لم","تحفيز",
           "سؤال","منشن","تحدي","لغز","دين","تحليل","مساعدة","بداية","موقف","رجوع"]
 
-def make_menu(secondary=False):
-    labels = MENU_B if secondary else MENU_A
+def _build_menu(labels):
     return QuickReply(items=[
         QuickReplyItem(action=MessageAction(label=l, text=l)) for l in labels
     ])
 
+def make_menu(secondary=False):
+    return FLEX["menu_b" if secondary else "menu_a"]
+
 # ═══════════════════════════ FLEX CORE ═══════════════════════════════
-def flex_msg(body_contents, footer_contents=None):
+ALT_TEXT = "بوت عناد المالكي"
+
+def bubble(body_contents, footer_contents=None):
     body = {
         "type": "box", "layout": "vertical",
         "backgroundColor": C['bg'],
@@ -190,11 +1190,78 @@ def flex_msg(body_contents, footer_contents=None):
             "paddingAll": "14px",
             "contents": footer_contents
         }
+    return d
+
+def flex_msg(body_contents, footer_contents=None):
     return FlexMessage(
-        alt_text="بوت عناد المالكي",
-        contents=FlexContainer.from_dict(d)
+        alt_text=ALT_TEXT,
+        contents=from_dict(bubble(body_contents, footer_contents))
     )
 
+class FlexTemplate:
+    """A bubble validated once with placeholder slots. render() fills the slots
+    by shallow-copying only the nodes on the path to each slot; the rest of the
+    validated skeleton is shared between renders and never re-validated."""
+
+    def __init__(self, build, *slots):
+        marks = {f"\x00{s}\x00": s for s in slots}
+        self.skeleton = from_dict(build(*marks))
+        self.wire     = None      # the skeleton's wire form, on first bubble_wire()
+        self.paths    = self._find(self.skeleton, marks) or {}
+        missing = set(slots) - set(self._leaves(self.paths))
+        if missing: raise ValueError(f"slots not found in template: {missing}")
+
+    @classmethod
+    def _find(cls, node, marks):
+        """Nested {attr|index: subtree|slot} for every field holding a marker."""
+        if isinstance(node, str):
+            return marks.get(node)
+        if isinstance(node, list):
+            items = enumerate(node)
+        elif hasattr(node, "__fields__"):
+            items = ((k, getattr(node, k)) for k in node.__fields__)
+        else:
+            return None
+        found = {}
+        for k, v in items:
+            sub = cls._find(v, marks)
+            if sub is not None: found[k] = sub
+        return found or None
+
+    @classmethod
+    def _leaves(cls, tree):
+        for sub in tree.values():
+            if isinstance(sub, str): yield sub
+            else: yield from cls._leaves(sub)
+
+    @classmethod
+    def _fill(cls, node, tree, values):
+        if isinstance(node, list):
+            node = list(node)
+            for k, sub in tree.items():
+                node[k] = str(values[sub]) if isinstance(sub, str) else cls._fill(node[k], sub, values)
+            return node
+        return node.copy(update={
+            k: str(values[sub]) if isinstance(sub, str) else cls._fill(getattr(node, k), sub, values)
+            for k, sub in tree.items()
+        })
+
+    def bubble_wire(self, **values):
+        """The filled bubble in wire form, without models: each given slot's
+        marker in the serialized skeleton replaced by its JSON-escaped value.
+        Slots not given keep their marker."""
+        if self.wire is None: self.wire = Wire.of(self.skeleton).data
+        data = self.wire
+        for slot, v in values.items():
+            data = data.replace(_dumps(f"\x00{slot}\x00")[1:-1], _dumps(str(v))[1:-1])
+        return Wire(data)
+
+    def render(self, **values):
+        return FlexMessage.construct(
+            type="flex", alt_text=ALT_TEXT,
+            contents=self._fill(self.skeleton, self.paths, values)
+        )
+
 def vbox(contents, **kw):
     return {"type": "box", "layout": "vertical", "contents": contents, **kw}
 
@@ -244,7 +1311,7 @@ def footer_credit():
               size="xs", color=C['subtle'], align="center")]
 
 # ═══════════════════════════ WELCOME FLEX ════════════════════════════
-def welcome_flex():
+def _build_welcome():
     return flex_msg([
         t("بوت عناد المالكي", size="xl", weight="bold",
           color=C['strong'], align="center"),
@@ -291,7 +1358,7 @@ def welcome_flex():
     footer_contents=footer_credit())
 
 # ═══════════════════════════ HELP FLEX ═══════════════════════════════
-def help_flex():
+def _build_help():
     cmds = [
         ("سؤال",         "سؤال للنقاش في القروب"),
         ("منشن",         "سؤال تذكر فيه شخص"),
@@ -326,7 +1393,7 @@ def help_flex():
     )
 
 # ═══════════════════════════ GAME FLEX ═══════════════════════════════
-def games_list_flex():
+def _build_games_list():
     btns = [btn_dark(f"{i+1}. {g.get('title','تحليل')}", str(i+1))
             for i, g in enumerate(cm.games)]
     return flex_msg([
@@ -338,19 +1405,32 @@ def games_list_flex():
         vbox(btns, margin="lg"),
     ])
 
-def question_flex(title, q, progress):
-    opts = [btn_light(f"{k}. {v}", k) for k, v in q['options'].items()]
-    return flex_msg([
+def _question_bubble(title, question, progress, *opts):
+    # opts alternates button label / answer key
+    btns = [btn_light(opts[i], opts[i+1]) for i in range(0, len(opts), 2)]
+    return bubble([
         hbox([
             t(title,    size="sm", weight="bold", color=C['body'], flex=5),
             t(progress, size="sm", color=C['subtle'], flex=1, align="end"),
         ]),
-        card_box([t(q['question'], color=C['body'])]),
-        vbox(opts, margin="lg"),
+        card_box([t(question, color=C['body'])]),
+        vbox(btns, margin="lg"),
     ])
 
-def result_flex(result_text):
-    return flex_msg([
+def question_flex(title, q, progress):
+    opts = q['options']
+    key  = ("question", len(opts))
+    tpl  = FLEX.get(key)
+    if tpl is None:
+        slots = [f"{p}{i}" for i in range(len(opts)) for p in ("label", "key")]
+        tpl = FLEX[key] = FlexTemplate(_question_bubble, "title", "question", "progress", *slots)
+    vals = {}
+    for i, (k, v) in enumerate(opts.items()):
+        vals[f"label{i}"], vals[f"key{i}"] = f"{k}. {v}", k
+    return tpl.render(title=title, question=q['question'], progress=progress, **vals)
+
+def _result_bubble(result_text):
+    return bubble([
         t("نتيجة التحليل", size="lg", weight="bold",
           color=C['strong'], align="center"),
         sep(),
@@ -359,14 +1439,17 @@ def result_flex(result_text):
     ],
     footer_contents=footer_credit())
 
+def result_flex(result_text):
+    return payload(("result", result_text), lambda: FLEX["result"].render(result_text=result_text))
+
 # ═══════════════════════════ RIDDLE FLEX ═════════════════════════════
-def riddle_flex(r, num, total):
-    return flex_msg([
+def _riddle_bubble(question, progress):
+    return bubble([
         hbox([
             t("لغز", size="sm", weight="bold", color=C['body'], flex=4),
-            t(f"{num}/{total}", size="sm", color=C['subtle'], flex=1, align="end"),
+            t(progress, size="sm", color=C['subtle'], flex=1, align="end"),
         ]),
-        card_box([t(r['question'], color=C['body'])]),
+        card_box([t(question, color=C['body'])]),
         hbox([
             btn_light("تلميح",  "تلميح"),
             btn_light("جواب",   "جواب"),
@@ -374,8 +1457,12 @@ def riddle_flex(r, num, total):
         ], margin="lg", spacing="sm"),
     ])
 
-def riddle_hint_flex(hint, question):
-    return flex_msg([
+def riddle_flex(r, num, total):
+    return payload(("riddle", r.question, num, total), lambda: FLEX["riddle"].render(
+        question=r.question, progress=f"{num}/{total}"))
+
+def _riddle_hint_bubble(hint, question):
+    return bubble([
         t("تلميح", size="sm", weight="bold", color=C['body']),
         card_box([t(hint, color=C['subtle'])]),
         vbox([t(question, size="xs", color=C['muted'])], margin="sm"),
@@ -385,22 +1472,30 @@ def riddle_hint_flex(hint, question):
         ], margin="lg", spacing="sm"),
     ])
 
-def riddle_answer_flex(answer, question):
-    return flex_msg([
+def riddle_hint_flex(hint, question):
+    return payload(("riddle_hint", hint, question), lambda: FLEX["riddle_hint"].render(
+        hint=hint, question=question))
+
+def _riddle_answer_bubble(answer, question):
+    return bubble([
         t("الجواب", size="sm", weight="bold", color=C['body']),
         card_box([t(answer, color=C['strong'], weight="bold")]),
         vbox([t(question, size="xs", color=C['muted'])], margin="sm"),
         vbox([btn_dark("التالي", "لغز")], margin="lg"),
     ])
 
+def riddle_answer_flex(answer, question):
+    return payload(("riddle_answer", answer, question), lambda: FLEX["riddle_answer"].render(
+        answer=answer, question=question))
+
 # ═══════════════════════════ DEEN FLEX ═══════════════════════════════
-def deen_flex(item, num, total):
-    return flex_msg([
+def _deen_bubble(question, progress):
+    return bubble([
         hbox([
             t("سؤال ديني", size="sm", weight="bold", color=C['body'], flex=5),
-            t(f"{num}/{total}", size="sm", color=C['subtle'], flex=1, align="end"),
+            t(progress, size="sm", color=C['subtle'], flex=1, align="end"),
         ]),
-        card_box([t(item['question'], color=C['body'])]),
+        card_box([t(question, color=C['body'])]),
         hbox([
             btn_light("تلميح",  "تلميح"),
             btn_light("جواب",   "جواب"),
@@ -408,8 +1503,12 @@ def deen_flex(item, num, total):
         ], margin="lg", spacing="sm"),
     ])
 
-def deen_hint_flex(hint, question):
-    return flex_msg([
+def deen_flex(item, num, total):
+    return payload(("deen", item.question, num, total), lambda: FLEX["deen"].render(
+        question=item.question, progress=f"{num}/{total}"))
+
+def _deen_hint_bubble(hint, question):
+    return bubble([
         t("تلميح", size="sm", weight="bold", color=C['body']),
         card_box([t(hint, color=C['subtle'])]),
         vbox([t(question, size="xs", color=C['muted'])], margin="sm"),
@@ -419,215 +1518,1076 @@ def deen_hint_flex(hint, question):
         ], margin="lg", spacing="sm"),
     ])
 
-def deen_answer_flex(answer, question):
-    return flex_msg([
+def deen_hint_flex(hint, question):
+    return payload(("deen_hint", hint, question), lambda: FLEX["deen_hint"].render(
+        hint=hint, question=question))
+
+def _deen_answer_bubble(answer, question):
+    return bubble([
         t("الجواب", size="sm", weight="bold", color=C['body']),
         card_box([t(answer, color=C['strong'], weight="bold")]),
         vbox([t(question, size="xs", color=C['muted'])], margin="sm"),
         vbox([btn_dark("التالي", "دين")], margin="lg"),
     ])
 
+def deen_answer_flex(answer, question):
+    return payload(("deen_answer", answer, question), lambda: FLEX["deen_answer"].render(
+        answer=answer, question=question))
+
+# ═══════════════════════════ CAROUSEL FLEX ═══════════════════════════
+def _item_bubble(title, text, progress):
+    return bubble([
+        hbox([
+            t(title, size="sm", weight="bold", color=C['body'], flex=4),
+            t(progress, size="sm", color=C['subtle'], flex=1, align="end"),
+        ]),
+        card_box([t(text, color=C['body'])]),
+    ])
+
+_PROGRESS = "\x00progress\x00"     # stands in for "i/n" in a cached item bubble
+
+def item_bubble(title, text):
+    """The cached wire form of one item bubble, its progress left as _PROGRESS."""
+    return payload(("bubble", title, text), lambda: FLEX["item"].bubble_wire(title=title, text=text))
+
+def carousel_flex(title, texts):
+    """One carousel of len(texts) item bubbles, joined from cached wire forms."""
+    n, mark = len(texts), _dumps(_PROGRESS)[1:-1]
+    bubbles = [item_bubble(title, x).data.replace(mark, f"{i + 1}/{n}".encode())
+               for i, x in enumerate(texts)]
+    return Wire(b'{"type":"flex","altText":%s,"contents":{"type":"carousel","contents":[%s]}}'
+                % (_dumps(ALT_TEXT), b",".join(bubbles)))
+
+# ═══════════════════════════ FLEX CACHE ══════════════════════════════
+def welcome_flex():    return FLEX["welcome"]
+def help_flex():       return FLEX["help"]
+def games_list_flex(): return FLEX["games"]
+
+def build_flex_cache():
+    """Build and validate every static screen and template skeleton once; the
+    screens are kept in wire form. Call again after the content they depend
+    on changes."""
+    cache = {
+        "menu_a":        _build_menu(MENU_A),
+        "menu_b":        _build_menu(MENU_B),
+        "welcome":       Wire.of(_build_welcome()),
+        "help":          Wire.of(_build_help()),
+        "games":         Wire.of(_build_games_list()),
+        "result":        FlexTemplate(_result_bubble, "result_text"),
+        "riddle":        FlexTemplate(_riddle_bubble, "question", "progress"),
+        "riddle_hint":   FlexTemplate(_riddle_hint_bubble, "hint", "question"),
+        "riddle_answer": FlexTemplate(_riddle_answer_bubble, "answer", "question"),
+        "deen":          FlexTemplate(_deen_bubble, "question", "progress"),
+        "deen_hint":     FlexTemplate(_deen_hint_bubble, "hint", "question"),
+        "deen_answer":   FlexTemplate(_deen_answer_bubble, "answer", "question"),
+        "item":          FlexTemplate(_item_bubble, "title", "text", "progress"),
+    }
+    FLEX.update(cache)      # one update, so readers never see a missing key
+
 # ═══════════════════════════ HELPERS ═════════════════════════════════
-def _txt(text):
-    return TextMessage(text=str(text))
-
-def calculate_result(answers, game_idx):
-    counts = {"أ": 0, "ب": 0, "ج": 0}
-    for a in answers:
-        if a in counts: counts[a] += 1
-    if not any(counts.values()):
-        return "شخصيتك مميزة ومختلفة"
-    max_val  = max(counts.values())
-    top_keys = [k for k, v in counts.items() if v == max_val]
-    key = top_keys[0] if len(top_keys) == 1 else \
-          next((a for a in answers if a in top_keys), top_keys[0])
-    return cm.results.get(f"لعبة{game_idx + 1}", {}).get(key, "شخصيتك مميزة ومختلفة")
+def chat_id(source):
+    """Rotation key for an event source: the group, else the room, else the user."""
+    return getattr(source, "group_id", None) or getattr(source, "room_id", None) \
+        or source.user_id
+
+def _game_valid(state):
+    """The session is in the packed format of the current game and not finished."""
+    games = cm.game_models
+    if "p" not in state or state["game"] >= len(games): return False
+    g = games[state["game"]]
+    return state.get("b") == g.bits and not g.done(state["p"])
+
+def reply_body(token, msgs):
+    return b'{"replyToken":%s,"messages":[%s]}' % (_dumps(token), b",".join(Wire.of(m).data for m in msgs))
+
+def _send(token, msgs):
+    """POST one reply call, its body joined from the messages' wire forms: the
+    SDK's pooled connection, headers and retries without its per-call model
+    serialization."""
+    t = time.perf_counter()
+    api, body = line_api(), reply_body(token, msgs)
+    try:
+        r = api.api_client.rest_client.pool_manager.request(
+            "POST", (configuration.host or api.line_base_path) + "/v2/bot/message/reply",
+            body=body, timeout=urllib3.Timeout(connect=LINE_TIMEOUT[0], read=LINE_TIMEOUT[1]),
+            headers={**api.api_client.default_headers, "User-Agent": api.api_client.user_agent,
+                     "Content-Type": "application/json", "Accept": "application/json"})
+        if r.status >= 300: raise RuntimeError(f"HTTP {r.status}: {r.data[:300].decode(errors='replace')}")
+    except Exception as e:
+        ERRORS.inc("reply")
+        logger.error(f"reply error: {e}")
+    traced("reply", t)
 
 def reply(token, msgs, secondary=False):
     if not msgs: return
-    msgs[-1].quick_reply = make_menu(secondary)
+    # cached messages are shared, so attach the menu to a copy
+    last = msgs[-1]
+    msgs[-1] = last.with_menu(menu_wire(secondary)) if isinstance(last, Wire) else \
+               last.copy(update={"quick_reply": make_menu(secondary)})
+    turn.rendered = time.perf_counter()
+    batch = getattr(turn, "batch", None)
+    if batch is not None: batch.add(turn.chat, token, msgs, turn.command)
+    else: _send(token, msgs)
+    turn.replied = time.perf_counter()
+
+class ReplyBatch:
+    """Replies collected over one webhook delivery and sent per chat at the end.
+    Every event brings its own reply token and a reply call takes up to five
+    messages, so a chat's messages go out in order, five per call, each call
+    spending one of that chat's tokens. The unused tokens just expire."""
+    MAX_MESSAGES = 5
+
+    def __init__(self):
+        self.chats    = {}   # chat → ([reply tokens], [messages], [the reply each message is from])
+        self.commands = []   # command of each reply, by the order they were added
+
+    def add(self, chat, token, msgs, command=None):
+        tokens, queued, owner = self.chats.setdefault(chat, ([], [], []))
+        tokens.append(token)
+        queued.extend(msgs)
+        owner.extend([len(self.commands)] * len(msgs))
+        self.commands.append(command)
+
+    def flush(self):
+        """Send, then time each command's reply phase as the calls that carried
+        its messages; a call shared by several commands counts for each."""
+        secs, n = [0.0] * len(self.commands), self.MAX_MESSAGES
+        for tokens, msgs, owner in self.chats.values():
+            calls = 0
+            for token, i in zip(tokens, range(0, len(msgs), n)):
+                t = time.perf_counter()
+                _send(token, msgs[i:i + n])
+                dt = time.perf_counter() - t
+                for k in set(owner[i:i + n]): secs[k] += dt
+                calls += 1
+            REPLY_CALLS.inc(n=calls)
+            if len(tokens) > calls: CALLS_SAVED.inc(n=len(tokens) - calls)
+        for cmd, dt in zip(self.commands, secs):
+            if cmd is not None and dt: PHASE_SECS.observe(dt, cmd, "reply")
+
+REPLY_COALESCE = os.getenv("REPLY_COALESCE", "1") == "1"
+
+def handle_delivery(body, sig):
+    """handler.handle() for one webhook delivery, with its replies coalesced
+    per chat; traced when the slow-request log is on."""
+    if SLOW_MS: turn.trace = Trace()
     try:
-        with ApiClient(configuration) as api:
-            MessagingApi(api).reply_message(
-                ReplyMessageRequest(reply_token=token, messages=msgs)
-            )
-    except Exception as e:
-        logger.error(f"reply error: {e}")
+        if not REPLY_COALESCE:
+            handler.handle(body, sig); return
+        turn.batch = batch = ReplyBatch()
+        try:
+            handler.handle(body, sig)
+        finally:
+            turn.batch = None
+            batch.flush()
+    finally:
+        if SLOW_MS:
+            turn.trace.done(); turn.trace = None
+
+# ═══════════════════════════ METRICS ═════════════════════════════════
+# Prometheus text exposition without the client library. Series are plain
+# lists bumped in place; a scrape only reads them. Under gunicorn each worker
+# also writes its series to a file in METRICS_DIR, and a scrape, whichever
+# worker serves it, merges the files (see metrics_text).
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+METRICS = []
+
+def _labels(names, values):
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    pairs = [f'{n}="{esc(v)}"' for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels, self.series = name, help, labels, {}
+        METRICS.append(self)
+
+    def inc(self, *values, n=1):
+        self.series[values] = self.series.get(values, 0) + n
+
+    def snapshot(self): return self.series
+
+    def expose(self, series=None):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} counter"
+        for values, v in sorted((self.series if series is None else series).items()):
+            yield f"{self.name}{_labels(self.labels, values)} {v}"
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series = {}     # label values → [count per bucket..., count above the last, sum]
+        METRICS.append(self)
+
+    def observe(self, value, *values):
+        s = self.series.get(values)
+        if s is None: s = self.series[values] = [0] * (len(self.buckets) + 2)
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def snapshot(self): return self.series
+
+    def expose(self, series=None):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} histogram"
+        for values, s in sorted((self.series if series is None else series).items()):
+            total = 0
+            for le, c in zip(self.buckets + ("+Inf",), s):
+                total += c
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), values + (le,))} {total}"
+            yield f"{self.name}_sum{_labels(self.labels, values)} {s[-1]}"
+            yield f"{self.name}_count{_labels(self.labels, values)} {total}"
+
+class Gauge:
+    """Read at scrape time from fn(), which returns a number or {label values: number}."""
+    def __init__(self, name, help, fn, labels=()):
+        self.name, self.help, self.fn, self.labels = name, help, fn, labels
+        METRICS.append(self)
+
+    def snapshot(self):
+        v = self.fn()
+        return v if isinstance(v, dict) else {(): v}
+
+    def expose(self, series=None):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} gauge"
+        for values, x in sorted((self.snapshot() if series is None else series).items()):
+            yield f"{self.name}{_labels(self.labels, values)} {x}"
+
+METRICS_DIR   = os.getenv("METRICS_DIR")     # set by gunicorn.conf.py; unset: this process only
+METRICS_EVERY = float(os.getenv("METRICS_EVERY", 1))
+_metrics_file = [None, None]                 # pid, path
+
+def write_metrics():
+    """Write this worker's series to its file in METRICS_DIR (atomically). The
+    name carries pid and start time, so a restarted worker reusing a pid
+    doesn't overwrite the counts of the one before it."""
+    if not METRICS_DIR: return
+    if _metrics_file[0] != os.getpid():
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _metrics_file[:] = os.getpid(), os.path.join(METRICS_DIR, f"{os.getpid()}-{time.time_ns()}.json")
+    path = _metrics_file[1]
+    data = {m.name: [[list(k), v] for k, v in m.snapshot().items()] for m in METRICS}
+    with open(f"{path}.tmp", "w") as fh: json.dump(data, fh)
+    os.replace(f"{path}.tmp", path)
+
+def _add(acc, key, v):
+    old = acc.get(key)
+    if old is None: acc[key] = list(v) if isinstance(v, list) else v
+    elif isinstance(v, list): acc[key] = [a + b for a, b in zip(old, v)]
+    else: acc[key] = old + v
+
+def merged_series():
+    """{metric name: series} summed over the files in METRICS_DIR. Counters and
+    histograms include workers that have exited, so they never go backwards;
+    gauges only count files written in the last few METRICS_EVERY."""
+    write_metrics()
+    live_since, out = time.time() - max(10, 3 * METRICS_EVERY), {m.name: {} for m in METRICS}
+    kinds = {m.name: m for m in METRICS}
+    for f in os.listdir(METRICS_DIR):
+        if not f.endswith(".json"): continue
+        path = os.path.join(METRICS_DIR, f)
+        try:
+            live = os.stat(path).st_mtime >= live_since
+            with open(path) as fh: data = json.load(fh)
+        except (OSError, ValueError):
+            continue                          # replaced or removed under us
+        for name, rows in data.items():
+            m = kinds.get(name)
+            if m is None or isinstance(m, Gauge) and not live: continue
+            for k, v in rows: _add(out[name], tuple(k), v)
+    return out
+
+def metrics_text():
+    if not METRICS_DIR:
+        return "\n".join(line for m in METRICS for line in m.expose()) + "\n"
+    merged = merged_series()
+    return "\n".join(line for m in METRICS for line in m.expose(merged[m.name])) + "\n"
+
+MESSAGES   = Counter("bot_messages_total", "Text messages received")
+COMMANDS_N = Counter("bot_commands_total", "Messages routed to a command", ("command",))
+PHASE_SECS = Histogram("bot_command_seconds", "Time per command by phase: dispatch "
+                       "(session and command lookup), render (draw and message build), "
+                       "reply (LINE API calls that carried it, shared ones counted "
+                       "for each command in them)", ("command", "phase"))
+WEBHOOK_N  = Histogram("bot_webhook_events", "Events per webhook delivery",
+                       buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+ERRORS     = Counter("bot_errors_total", "Errors by where they happened", ("where",))
+REPLY_CALLS = Counter("bot_reply_calls_total", "Coalesced reply API calls made")
+CALLS_SAVED = Counter("bot_reply_calls_saved_total",
+                      "Reply API calls avoided by coalescing a chat's replies")
+SLOW_N     = Counter("bot_slow_deliveries_total", "Deliveries over SLOW_REQUEST_MS")
+Gauge("bot_sessions", "Session store size and eviction counts",
+      lambda: {(k,): v for k, v in cm.sessions.stats().items()}, ("stat",))
+Gauge("bot_rotation_chats", "Chats with rotation state held by the workers", lambda: len(cm.used))
+Gauge("bot_dispatch_queue", "Async dispatch queue depth", lambda: dispatcher.q.qsize())
+Gauge("bot_rate_buckets", "Token buckets held by the rate limiter",
+      lambda: {("user",): len(user_limit), ("answer",): len(answer_limit), ("chat",): len(chat_limit)},
+      ("scope",))
+
+class TimedValidator(SignatureValidator):
+    def validate(self, body, signature):
+        t = time.perf_counter()
+        try: return super().validate(body, signature)
+        finally: traced("verify", t)
+
+class MeteredParser(WebhookParser):
+    """Records the number of events in each delivery it parses, and its
+    verify and parse time in the delivery's trace."""
+    def __init__(self, channel_secret, skip_signature_verification=lambda: False):
+        super().__init__(channel_secret, skip_signature_verification)
+        self.signature_validator = TimedValidator(channel_secret)
+
+    def parse(self, body, signature, as_payload=False):
+        tr, t = getattr(turn, "trace", None), time.perf_counter()
+        v0 = tr.secs["verify"] if tr else 0.0
+        payload = super().parse(body, signature, as_payload=as_payload)
+        if tr: tr.secs["parse"] += time.perf_counter() - t - (tr.secs["verify"] - v0)
+        WEBHOOK_N.observe(len(payload.events if as_payload else payload))
+        return payload
+
+handler.parser = MeteredParser(os.getenv("LINE_CHANNEL_SECRET"))
+
+def routed(command):
+    """Mark the end of dispatch for the current event: `command` handles it."""
+    turn.command, turn.routed = command, time.perf_counter()
+
+# ═══════════════════════════ PAYLOADS ════════════════════════════════
+# Content replies kept in their final JSON form: a reply call is built by
+# joining bytes (see _send), with no message models to build or serialize.
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+class Wire:
+    """A message in its wire (JSON) form; reply() and _send() take it in
+    place of a message model."""
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def of(cls, msg):
+        if isinstance(msg, cls): return msg
+        return cls(_dumps(line_api().api_client.sanitize_for_serialization(msg)))
+
+    @classmethod
+    def text(cls, s):
+        return cls(_dumps({"type": "text", "text": s}))
+
+    def with_menu(self, menu):
+        return Wire(self.data[:-1] + b',"quickReply":' + menu + b"}")
+
+class PayloadCache:
+    """Wire forms keyed by what they are built from, so a content reload can't
+    leave an entry stale — changed items just stop being asked for. LRU within
+    `budget` bytes, counting each payload and its key."""
+
+    def __init__(self, budget):
+        self.budget, self.size = budget, 0
+        self.data = OrderedDict()           # key → (wire, cost)
+        self.lock = threading.Lock()
+
+    def __len__(self): return len(self.data)
+
+    def get(self, key, build):
+        with self.lock:
+            hit = self.data.get(key)
+            if hit is not None:
+                self.data.move_to_end(key)
+                PAYLOAD_N.inc("hit")
+                return hit[0]
+        PAYLOAD_N.inc("miss")
+        w = Wire.of(build())
+        cost = len(w.data) + sum(sys.getsizeof(k) for k in key) + 100
+        if cost > self.budget: return w
+        with self.lock:
+            if key in self.data: return w
+            self.data[key] = (w, cost)
+            self.size += cost
+            while self.size > self.budget:
+                self.size -= self.data.popitem(last=False)[1][1]
+                PAYLOAD_N.inc("evict")
+        return w
+
+    def full(self):
+        return self.size >= self.budget
+
+    def stats(self):
+        n = PAYLOAD_N.series
+        hits, misses = n.get(("hit",), 0), n.get(("miss",), 0)
+        return {"entries": len(self.data), "bytes": self.size, "budget": self.budget,
+                "hits": hits, "misses": misses, "evictions": n.get(("evict",), 0),
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None}
+
+PAYLOAD_N = Counter("bot_payload_cache_total", "Payload cache lookups and evictions", ("result",))
+payloads  = PayloadCache(int(float(os.getenv("PAYLOAD_CACHE_MB", 8)) * 2**20))
+Gauge("bot_payload_cache_bytes", "Bytes held by the payload cache", lambda: payloads.size)
+
+def payload(key, build):
+    """The cached wire form of the message build() makes."""
+    return payloads.get(key, build)
+
+def text_payload(s):
+    return payloads.get(("text", s), lambda: Wire.text(s))
+
+_menus = {}     # secondary → (menu model, its wire form)
+
+def menu_wire(secondary):
+    menu = make_menu(secondary)
+    hit  = _menus.get(secondary)
+    if hit is None or hit[0] is not menu:
+        hit = _menus[secondary] = (menu, _dumps(line_api().api_client.sanitize_for_serialization(menu)))
+    return hit[1]
+
+build_flex_cache()     # after Wire: the static screens are stored in wire form
+
+# ═══════════════════════════ ABUSE LIMITS ════════════════════════════
+class TokenBuckets:
+    """One token bucket per key: `rate` tokens/s up to `burst`. Buckets are kept
+    in sharded LRU order and capped at `max_keys`; a dropped bucket comes back full."""
+
+    def __init__(self, rate, burst, max_keys=50000):
+        self.rate, self.burst, self.max_keys = rate, burst, max_keys
+        self.buckets = Shards(max_keys)         # key → [tokens, last refill]
+
+    def __len__(self): return len(self.buckets)
+
+    def allow(self, key, now):
+        if not self.rate: return True
+        lock, buckets = self.buckets.of(key)
+        with lock:
+            b = buckets.get(key)
+            if b is None:
+                b = buckets[key] = [self.burst, now]
+                if len(buckets) > self.buckets.cap: buckets.popitem(last=False)
+            else:
+                buckets.move_to_end(key)
+                b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+                b[1] = now
+            if b[0] < 1: return False
+            b[0] -= 1
+            return True
+
+class RecentIds:
+    """The last `size` webhookEventIds seen, for dropping redelivered events."""
+
+    def __init__(self, size=10000):
+        self.size, self.ids, self.lock = size, OrderedDict(), threading.Lock()
+
+    def seen(self, event_id):
+        if not event_id or not self.size: return False
+        with self.lock:
+            if event_id in self.ids: return True
+            self.ids[event_id] = None
+            if len(self.ids) > self.size: self.ids.popitem(last=False)
+            return False
+
+user_limit = TokenBuckets(float(os.getenv("RATE_USER_PER_SEC", 1)),
+                          float(os.getenv("RATE_USER_BURST", 5)))
+chat_limit = TokenBuckets(float(os.getenv("RATE_CHAT_PER_SEC", 5)),
+                          float(os.getenv("RATE_CHAT_BURST", 20)))
+# answers to an open game/riddle/deen come in quick taps: their own, looser per-user bucket
+answer_limit = TokenBuckets(float(os.getenv("RATE_ANSWER_PER_SEC", 4)),
+                            float(os.getenv("RATE_ANSWER_BURST", 12)))
+recent_events = RecentIds(int(os.getenv("DEDUP_EVENTS", 10000)))
+DROPPED = Counter("bot_dropped_events_total", "Events dropped before handling", ("reason",))
+
+def admit(command, uid, chat):
+    """routed(command), then charge the user's and the chat's buckets; the
+    user's answer bucket for session:* routes. False means the event is over
+    the limit and gets no reply."""
+    routed(command)
+    now   = turn.routed
+    users = answer_limit if command.startswith("session:") else user_limit
+    if users.allow(uid, now) and chat_limit.allow(chat, now): return True
+    DROPPED.inc("rate_limited")
+    turn.command = None
+    return False
+
+# ═══════════════════════════ DISPATCH ════════════════════════════════
+class Dispatcher:
+    """Bounded in-process work queue for webhook deliveries.
+    /callback verifies the signature, submits the body and acks at once; worker
+    threads (greenlets under gevent) run the handlers and the reply calls.
+    A delivery is one job, so events from the same batch keep their order.
+    When the queue is full the caller handles the delivery inline instead."""
+
+    def __init__(self, workers=8, maxsize=256):
+        self.workers = workers
+        self.q       = queue.Queue(maxsize)
+        self.pid     = None
+        self.lock    = threading.Lock()
+        self.closed  = False
+        self.stats   = {"submitted": 0, "inline": 0, "done": 0, "errors": 0, "max_depth": 0}
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid(): return
+            for _ in range(self.workers):
+                threading.Thread(target=self._run, daemon=True).start()
+            self.pid = os.getpid()
+
+    def submit(self, body, sig):
+        if self.closed: return False
+        if self.pid != os.getpid(): self._start()
+        try:
+            self.q.put_nowait((body, sig))
+        except queue.Full:
+            self.stats["inline"] += 1
+            return False
+        self.stats["submitted"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.q.qsize())
+        return True
+
+    def _run(self):
+        while True:
+            job = self.q.get()
+            try:
+                if job is None: return
+                handle_delivery(*job)
+                self.stats["done"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                ERRORS.inc("dispatch")
+                logger.error(f"dispatch error: {e}")
+            finally:
+                self.q.task_done()
+
+    def snapshot(self):
+        return {**self.stats, "depth": self.q.qsize(), "capacity": self.q.maxsize}
+
+    def drain(self, timeout=20):
+        """Stop accepting work and wait (up to `timeout` s) for queued jobs."""
+        if self.closed: return
+        self.closed = True
+        if self.pid != os.getpid(): return
+        deadline = time.monotonic() + timeout
+        while self.q.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        left = self.q.unfinished_tasks
+        if left: logger.warning(f"dispatch drain timed out with {left} jobs left")
+        for _ in range(self.workers):
+            try: self.q.put_nowait(None)
+            except queue.Full: break
+
+ASYNC_DISPATCH = os.getenv("ASYNC_DISPATCH", "0") == "1"
+dispatcher = Dispatcher(workers=int(os.getenv("DISPATCH_WORKERS", 8)),
+                        maxsize=int(os.getenv("DISPATCH_QUEUE", 256)))
+if ASYNC_DISPATCH:
+    atexit.register(lambda: dispatcher.drain(float(os.getenv("DISPATCH_DRAIN_TIMEOUT", 20))))
+
+# ═══════════════════════════ CONTENT RELOAD ══════════════════════════
+def reload_content(force=False):
+    """Swap in changed content files and rebuild the Flex screens built from them."""
+    changed = cm.reload(force)
+    if changed: build_flex_cache()
+    return changed
+
+def check_content():
+    """Poll content mtimes; each worker runs this from its scheduler."""
+    changed = reload_content()
+    if changed:
+        logger.info(f"content reloaded: {', '.join(changed)}")
+        if payloads.budget: prerender()
+
+# ═══════════════════════════ SHARD MODE ══════════════════════════════
+# Behind router.py each chat is pinned to one backend. Deliveries carry the
+# router's ring (version, members, and this backend's URL in it); a new one
+# means chats may have moved in or out.
+SHARD = {"ring": None, "rebalances": 0, "moved_in": 0, "moved_out": 0, "reload_secs": 0.0}
+_shard_lock = threading.Lock()
+_shard_ring = None      # HashRing adopted last
+
+def adopt_ring(version, nodes, me):
+    """Hand over the chats this backend no longer owns and take in the ones
+    it gained: write out the journal, drop the chats the new ring sends
+    elsewhere, and load the saved state of chats that just moved here (at
+    most one flush interval behind, when the backends share STATE_DB).
+    Chats that stay put are untouched. Yields between chunks, so the worker
+    keeps serving while it runs."""
+    global _shard_ring
+    with _shard_lock:
+        if SHARD["ring"] == version: return
+        SHARD["ring"] = version
+        ring = HashRing([n for n in nodes.split(",") if n])
+        if ring.version != version or me not in ring.nodes:
+            logger.warning(f"shard ring {version}: members {nodes!r} / {me!r} don't match; keeping all chats")
+            return
+        old, _shard_ring, t0 = _shard_ring, ring, time.perf_counter()
+        if journal is not None: journal.flush()      # the new owner reads what leaves from here
+        out = cm.used.drop(lambda chat: ring.node(chat) != me)
+        n = 0
+        if journal is not None and old is not None:  # the first ring: boot already restored everything
+            n = journal.restore_where(lambda chat: ring.node(chat) == me and old.node(chat) != me)
+        SHARD["rebalances"] += 1; SHARD["moved_out"] += out; SHARD["moved_in"] += n
+        SHARD["reload_secs"] = time.perf_counter() - t0
+        logger.info(f"shard ring {version}: dropped {out} chats, loaded {n} chats/sessions "
+                    f"in {SHARD['reload_secs'] * 1e3:.1f} ms")
 
 # ═══════════════════════════ ROUTES ══════════════════════════════════
 @app.route("/")
 def home(): return "OK"
 
 @app.route("/health")
-def health(): return {"ok": True}
+def health():
+    d = {"ok": True, "sessions": cm.sessions.stats()}
+    if journal is not None: d["state"] = journal.snapshot()
+    d["jobs"] = scheduler.stats
+    d["payloads"] = payloads.stats()
+    if SHARD["ring"] is not None: d["shard"] = SHARD
+    if ASYNC_DISPATCH: d["dispatch"] = dispatcher.snapshot()
+    if profiler is not None: d["profile"] = {**profiler.stats, "stacks": len(profiler.stacks)}
+    return d
+
+def admin_only():
+    """Admin routes need ADMIN_TOKEN as a bearer token; without one set they don't exist."""
+    token = os.getenv("ADMIN_TOKEN")
+    if not token: abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(403)
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    admin_only()
+    return {"changed": reload_content(force=request.args.get("force") == "1")}
+
+@app.route("/admin/search")
+def admin_search():
+    admin_only()
+    q, cat = request.args.get("q", ""), request.args.get("category")
+    if cat is not None and cat not in SEARCH_FIELDS: abort(400)
+    limit = max(0, min(request.args.get("limit", 50, type=int), 500))
+    files = {f: s[0] for f, s in cm.SOURCES.items()}
+    return {"results": [
+        {"category": c, "file": files[SEARCH_FIELDS[c]], "index": i, "text": item_text(item).strip()}
+        for c, i, item in cm.search(q, [cat] if cat else None, limit)]}
+
+@app.route("/admin/profile")
+def admin_profile():
+    """This worker's sampled stacks, folded (flamegraph.pl / speedscope);
+    ?reset=1 starts a new window."""
+    admin_only()
+    if profiler is None: abort(404)
+    return profiler.dump(request.args.get("reset") == "1"), 200, {
+        "Content-Type": "text/plain; charset=utf-8",
+        "X-Profile-Samples": str(profiler.stats["samples"]), "X-Profile-Hz": f"{PROFILE_HZ:g}"}
+
+@app.route("/metrics")
+def metrics():
+    return metrics_text(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 @app.route("/callback", methods=["POST"])
 def callback():
     sig  = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
+    ring = request.headers.get("X-Shard-Ring")
+    if ring is not None and ring != SHARD["ring"] \
+            and handler.parser.signature_validator.validate(body, sig):
+        adopt_ring(ring, request.headers.get("X-Shard-Nodes", ""), request.headers.get("X-Shard-Self", ""))
+    if ASYNC_DISPATCH:
+        if not handler.parser.signature_validator.validate(body, sig):
+            ERRORS.inc("signature"); abort(400)
+        if dispatcher.submit(body, sig):
+            return "OK"
     try:
-        handler.handle(body, sig)
+        handle_delivery(body, sig)
     except InvalidSignatureError:
-        abort(400)
+        ERRORS.inc("signature"); abort(400)
     return "OK"
 
+PROFILE_ROOTS = {callback.__code__, handle_delivery.__code__}
+
 # ═══════════════════════════ MAIN HANDLER ════════════════════════════
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle(event):
+    t0 = turn.routed = time.perf_counter()
+    turn.command = None; turn.rendered = 0
+    MESSAGES.inc()
+    if recent_events.seen(getattr(event, "webhook_event_id", None)):
+        DROPPED.inc("duplicate"); return
+    try:
+        route(event)
+    except Exception:
+        ERRORS.inc("handle"); raise
+    finally:
+        cmd, tr = turn.command, getattr(turn, "trace", None)
+        if cmd is not None:
+            COMMANDS_N.inc(cmd)
+            PHASE_SECS.observe(turn.routed - t0, cmd, "dispatch")
+            if turn.rendered:
+                PHASE_SECS.observe(turn.rendered - turn.routed, cmd, "render")
+                if getattr(turn, "batch", None) is None:    # else timed when the batch is sent
+                    PHASE_SECS.observe(turn.replied - turn.rendered, cmd, "reply")
+        if tr is not None:
+            tr.secs["dispatch"] += turn.routed - t0
+            if turn.rendered: tr.secs["flex"] += turn.rendered - turn.routed
+            if cmd is not None: tr.commands.append(cmd)
+
+def route(event):
     uid  = event.source.user_id
+    chat = turn.chat = chat_id(event.source)
     text = event.message.text.strip()
 
+    sess = cm.sessions
+    game_key, riddle_key, deen_key = f"game:{uid}", f"riddle:{uid}", f"deen:{uid}"
+    state, rs, ds = sess.get_many([game_key, riddle_key, deen_key])
+
     # ── PRIORITY 1: Game in progress ─────────────────────────────────
-    if uid in cm.game_state:
-        state = cm.game_state[uid]
-        if text in ["أ", "ب", "ج"]:
-            state["answers"].append(text)
-            game   = cm.games[state["game"]]
-            q_next = state["q"] + 1
-            if q_next < len(game["questions"]):
-                state["q"] = q_next
-                reply(event.reply_token, [
-                    question_flex(game["title"], game["questions"][q_next],
-                                  f"{q_next+1}/{len(game['questions'])}")
-                ])
-            else:
-                res = calculate_result(state["answers"], state["game"])
-                del cm.game_state[uid]
-                reply(event.reply_token, [result_flex(res)])
-        else:
-            game = cm.games[state["game"]]
-            q    = state["q"]
-            reply(event.reply_token, [
-                question_flex(game["title"], game["questions"][q],
-                              f"{q+1}/{len(game['questions'])}")
-            ])
+    if state is not None and not _game_valid(state):   # content reloaded under it
+        sess.delete(game_key); state = None
+    if state is not None:
+        if not admit("session:game", uid, chat): return
+        game = cm.game_models[state["game"]]
+        if text in game.options[game.step(state["p"])]:
+            finished = []
+            def answer(s):
+                if s is None or not _game_valid(s): return None
+                p = game.answer(s["p"], text)
+                if p is None: return s
+                if not game.done(p):
+                    s["p"] = p; return s
+                finished.append(p)
+                return None
+            state = sess.update(game_key, answer)
+            if finished:
+                reply(event.reply_token, [result_flex(game.result(finished[0]))]); return
+            if state is None: return
+        reply(event.reply_token, [game.message(game.step(state["p"]))])
         return
 
     # ── PRIORITY 2: Riddle in progress ───────────────────────────────
-    if uid in cm.riddle_state:
-        rs     = cm.riddle_state[uid]
-        riddle = cm.riddles[rs["idx"]]
+    riddles = cm.riddles if rs is not None else ()
+    if rs is not None and rs["idx"] >= len(riddles):
+        sess.delete(riddle_key); rs = None
+    if rs is not None:
+        if not admit("session:riddle", uid, chat): return
+        riddle = riddles[rs["idx"]]
         if text == "تلميح":
             reply(event.reply_token,
-                  [riddle_hint_flex(riddle.get("hint","لا يوجد تلميح"), riddle["question"])]); return
+                  [riddle_hint_flex(riddle.hint, riddle.question)]); return
         if text == "جواب":
-            del cm.riddle_state[uid]
+            sess.delete(riddle_key)
             reply(event.reply_token,
-                  [riddle_answer_flex(riddle["answer"], riddle["question"])]); return
+                  [riddle_answer_flex(riddle.answer, riddle.question)]); return
         if text == "لغز":
-            del cm.riddle_state[uid]
+            sess.delete(riddle_key)
             # fall through to start new riddle
         else:
-            reply(event.reply_token, [_txt('اضغط "تلميح" او "جواب"')]); return
+            reply(event.reply_token, [text_payload('اضغط "تلميح" او "جواب"')]); return
 
     # ── PRIORITY 3: Deen in progress ─────────────────────────────────
-    if uid in cm.deen_state:
-        ds   = cm.deen_state[uid]
-        item = cm.religion[ds["idx"]]
+    religion = cm.religion if ds is not None else ()
+    if ds is not None and ds["idx"] >= len(religion):
+        sess.delete(deen_key); ds = None
+    if ds is not None:
+        if not admit("session:deen", uid, chat): return
+        item = religion[ds["idx"]]
         if text == "تلميح":
             reply(event.reply_token,
-                  [deen_hint_flex(item.get("hint","لا يوجد تلميح"), item["question"])]); return
+                  [deen_hint_flex(item.hint, item.question)]); return
         if text == "جواب":
-            del cm.deen_state[uid]
+            sess.delete(deen_key)
             reply(event.reply_token,
-                  [deen_answer_flex(item["answer"], item["question"])]); return
+                  [deen_answer_flex(item.answer, item.question)]); return
         if text == "دين":
-            del cm.deen_state[uid]
+            sess.delete(deen_key)
             # fall through to start new question
         else:
-            reply(event.reply_token, [_txt('اضغط "تلميح" او "جواب"')]); return
+            reply(event.reply_token, [text_payload('اضغط "تلميح" او "جواب"')]); return
 
     # ── Game selection by number ──────────────────────────────────────
-    if text.isdigit():
-        idx = int(text) - 1
-        if 0 <= idx < len(cm.games):
-            cm.game_state[uid] = {"game": idx, "q": 0, "answers": []}
-            g = cm.games[idx]
-            reply(event.reply_token, [
-                question_flex(g["title"], g["questions"][0],
-                              f"1/{len(g['questions'])}")
-            ])
+    if text.isdecimal():
+        if not admit("game:start", uid, chat): return
+        start_game(event, uid, int(text) - 1); return
+
+    fn = COMMANDS.get(text)
+    if fn is not None:
+        if admit(text, uid, chat): fn(event, uid, chat)
         return
 
-    # ── Navigation ────────────────────────────────────────────────────
-    if text in ["بداية","ابدأ","start"]:
-        reply(event.reply_token, [welcome_flex()]); return
-
-    if text == "مساعدة":
-        reply(event.reply_token, [help_flex()]); return
-
-    if text == "المزيد":
-        reply(event.reply_token, [_txt("تفضل:")], secondary=True); return
-
-    if text == "رجوع":
-        reply(event.reply_token, [_txt("تفضل:")], secondary=False); return
-
-    # ── تحليل ─────────────────────────────────────────────────────────
-    if text == "تحليل":
-        reply(event.reply_token, [games_list_flex()]); return
-
-    # ── لغز ───────────────────────────────────────────────────────────
-    if text == "لغز":
-        if not cm.riddles:
-            reply(event.reply_token, [_txt("لا تتوفر الغاز")]); return
-        r   = cm.get_random("لغز", cm.riddles)
-        idx = cm.riddles.index(r)
-        cm.riddle_state[uid] = {"idx": idx}
-        reply(event.reply_token, [riddle_flex(r, idx+1, len(cm.riddles))]); return
-
-    # ── دين ───────────────────────────────────────────────────────────
-    if text == "دين":
-        if not cm.religion:
-            reply(event.reply_token, [_txt("لا تتوفر اسئلة")]); return
-        r   = cm.get_random("دين", cm.religion)
-        idx = cm.religion.index(r)
-        cm.deen_state[uid] = {"idx": idx}
-        reply(event.reply_token, [deen_flex(r, idx+1, len(cm.religion))]); return
-
-    # ── Plain text commands ────────────────────────────────────────────
-    plain = {
-        "قصة":         cm.stories,
-        "فلسفة":       cm.philosophy,
-        "لو كنت":      cm.scenarios,
-        "أيهما أصعب": cm.choices,
-        "أنا لم":      cm.never,
-        "تحفيز":       cm.motivation,
-    }
-    if text in plain:
-        item = cm.get_random(text, plain[text])
-        reply(event.reply_token, [_txt(item or "—")]); return
-
-    # ── Original content ──────────────────────────────────────────────
-    original = {
-        "سؤال":   ("سؤال",   cm.files["سؤال"]),
-        "تحدي":   ("تحدي",   cm.files["تحدي"]),
-        "اعتراف": ("اعتراف", cm.files["اعتراف"]),
-        "منشن":   ("منشن",   cm.mention),
-        "موقف":   ("موقف",   cm.situations),
-        "اقتباس": ("اقتباس", cm.quotes),
-    }
-    if text in original:
-        cat, data = original[text]
-        item = cm.get_random(cat, data)
-        if text == "اقتباس" and isinstance(item, dict):
-            author = item.get("author","").strip()
-            msg    = item.get("text","—")
-            if author and author != "غير معروف": msg = f"{msg}\n\n— {author}"
-        else:
-            msg = item if isinstance(item, str) else "—"
-        reply(event.reply_token, [_txt(msg or "—")])
+    # ── Spelling variants: "ايهما اصعب", tatweel, diacritics, emoji ──────
+    key = command_key(text, COMMAND_HEADS)
+    if key is None: return
+    hit = COMMAND_KEYS.get(key)
+    if hit is not None:
+        if admit(hit[0], uid, chat): hit[1](event, uid, chat)
+        return
 
-# ═══════════════════════════ KEEP ALIVE ══════════════════════════════
-def keep_alive():
-    url = os.getenv("RENDER_EXTERNAL_URL","")
-    if url and not url.startswith("http"): url = "https://" + url
-    while True:
-        try:
-            if url: requests.get(url+"/health", timeout=5)
-        except Exception: pass
-        time.sleep(600)
+    # ── "<command>: <keywords>": a random item matching the keywords ────
+    # Only with the colon: "سؤال حلو" or "لو كنت مكانك" is chatter, not a query.
+    for head in KEYWORD_HEADS.get(key.partition(" ")[0], ()):
+        if key.startswith(head + " "):
+            name, fn = KEYWORD[head]
+            query = key[len(head):].strip()
+            if query.isdecimal() and name in BATCH:        # "سؤال 10": a carousel of 10
+                if admit(f"batch:{name}", uid, chat): send_batch(event, chat, name, int(query))
+            elif search_head(text) == head and admit(f"search:{name}", uid, chat):
+                fn(event, uid, chat, query)
+            return
+
+# ═══════════════════════════ COMMANDS ════════════════════════════════
+COMMANDS     = {}    # exact message text → fn(event, uid, chat)
+COMMAND_KEYS = {}    # command_key(name) → (name, fn), for spelling variants
+KEYWORD  = {}        # command_key(name) → (name, fn(event, uid, chat, query))
+KEYWORD_HEADS = {}   # first word → keyword command keys starting with it, longest first
+COMMAND_HEADS = set()  # first words of every command key
+
+def command(*names):
+    """Register the decorated fn(event, uid, chat) for each of `names`."""
+    def register(fn):
+        for n in names:
+            COMMANDS[n] = fn
+            key = command_key(n)
+            COMMAND_KEYS.setdefault(key, (n, fn))
+            COMMAND_HEADS.add(key.split()[0])
+        return fn
+    return register
+
+def search_head(text):
+    """command_key() of what precedes the first ":" in `text`, or None without one."""
+    head, sep, _ = text.partition(":")
+    return command_key(head) if sep else None
+
+def keyword(name):
+    """Register the decorated fn(event, uid, chat, query) for "<name>: <query>"."""
+    def register(fn):
+        key = command_key(name)
+        KEYWORD[key] = (name, fn)
+        COMMAND_HEADS.add(key.split()[0])
+        heads = KEYWORD_HEADS.setdefault(key.split()[0], [])
+        heads.append(key); heads.sort(key=len, reverse=True)
+        return fn
+    return register
+
+def start_game(event, uid, idx):
+    games = cm.game_models
+    if not 0 <= idx < len(games) or not games[idx].questions: return
+    g = games[idx]
+    cm.sessions.set(f"game:{uid}", {"game": idx, "p": 0, "b": g.bits})
+    reply(event.reply_token, [g.message(0)])
+
+# ── Navigation ────────────────────────────────────────────────────────
+@command("بداية", "ابدأ", "start")
+def cmd_welcome(event, uid, chat):
+    reply(event.reply_token, [welcome_flex()])
+
+@command("مساعدة")
+def cmd_help(event, uid, chat):
+    reply(event.reply_token, [help_flex()])
+
+@command("المزيد")
+def cmd_more(event, uid, chat):
+    reply(event.reply_token, [text_payload("تفضل:")], secondary=True)
+
+@command("رجوع")
+def cmd_back(event, uid, chat):
+    reply(event.reply_token, [text_payload("تفضل:")], secondary=False)
+
+# ── تحليل ─────────────────────────────────────────────────────────────
+@command("تحليل")
+def cmd_games(event, uid, chat):
+    reply(event.reply_token, [games_list_flex()])
+
+# ── لغز ───────────────────────────────────────────────────────────────
+@command("لغز")
+def cmd_riddle(event, uid, chat):
+    riddles = cm.riddles
+    if not riddles:
+        reply(event.reply_token, [text_payload("لا تتوفر الغاز")]); return
+    idx, r = cm.draw("لغز", riddles, chat)
+    cm.sessions.set(f"riddle:{uid}", {"idx": idx})
+    reply(event.reply_token, [riddle_flex(r, idx+1, len(riddles))])
+
+# ── دين ───────────────────────────────────────────────────────────────
+@command("دين")
+def cmd_deen(event, uid, chat):
+    religion = cm.religion
+    if not religion:
+        reply(event.reply_token, [text_payload("لا تتوفر اسئلة")]); return
+    idx, r = cm.draw("دين", religion, chat)
+    cm.sessions.set(f"deen:{uid}", {"idx": idx})
+    reply(event.reply_token, [deen_flex(r, idx+1, len(religion))])
+
+# ── Text content ──────────────────────────────────────────────────────
+# command → its content list, looked up on cm at draw time
+TEXT_CONTENT = {
+    "سؤال":        lambda: cm.files["سؤال"],
+    "تحدي":        lambda: cm.files["تحدي"],
+    "اعتراف":      lambda: cm.files["اعتراف"],
+    "منشن":        lambda: cm.mention,
+    "موقف":        lambda: cm.situations,
+    "قصة":         lambda: cm.stories,
+    "فلسفة":       lambda: cm.philosophy,
+    "لو كنت":      lambda: cm.scenarios,
+    "أيهما أصعب": lambda: cm.choices,
+    "أنا لم":      lambda: cm.never,
+    "تحفيز":       lambda: cm.motivation,
+}
+
+NO_MATCH = "لا يوجد شي بهالكلمة، جرب كلمة ثانية"
+
+def _text_command(key, data):
+    def send(event, uid, chat):
+        item = cm.get_random(key, data(), chat)
+        reply(event.reply_token, [text_payload(item if isinstance(item, str) and item else "—")])
+    return send
+
+def _text_search(key):
+    def send(event, uid, chat, query):
+        idx, item = cm.draw_matching(key, query)
+        if idx is None: item = NO_MATCH
+        reply(event.reply_token, [text_payload(item if isinstance(item, str) and item else "—")])
+    return send
+
+for _key, _data in TEXT_CONTENT.items():
+    command(_key)(_text_command(_key, _data))
+    keyword(_key)(_text_search(_key))
+
+def _quote_text(item):
+    if isinstance(item, dict):
+        author = item.get("author","").strip()
+        msg    = item.get("text","—")
+        if author and author != "غير معروف": msg = f"{msg}\n\n— {author}"
+    else:
+        msg = item if isinstance(item, str) else "—"
+    return msg or "—"
+
+@command("اقتباس")
+def cmd_quote(event, uid, chat):
+    reply(event.reply_token, [text_payload(_quote_text(cm.get_random("اقتباس", cm.quotes, chat)))])
+
+@keyword("اقتباس")
+def cmd_quote_search(event, uid, chat, query):
+    idx, item = cm.draw_matching("اقتباس", query)
+    reply(event.reply_token, [text_payload(NO_MATCH if idx is None else _quote_text(item))])
+
+# ── "<command> N": N items in one carousel ─────────────────────────────
+BATCH_MAX = min(12, max(1, int(os.getenv("BATCH_MAX", 10))))   # a carousel holds at most 12 bubbles
+BATCH = {**{k: (data, lambda x: x if isinstance(x, str) and x else "—")
+            for k, data in TEXT_CONTENT.items()},
+         "اقتباس": (lambda: cm.quotes, _quote_text)}
+
+def send_batch(event, chat, name, n):
+    data, fmt = BATCH[name]
+    items = cm.draw_many(name, data(), chat, max(1, min(n, BATCH_MAX)))
+    if not items:
+        reply(event.reply_token, [text_payload("—")]); return
+    if len(items) == 1:
+        reply(event.reply_token, [text_payload(fmt(items[0][1]))]); return
+    reply(event.reply_token, [carousel_flex(name, [fmt(item) for _, item in items])])
+
+# ═══════════════════════════ SCHEDULER ═══════════════════════════════
+class Scheduler:
+    """Per-worker background jobs on one thread — a greenlet under gevent,
+    whose monkey patching makes time.sleep yield to the hub. A job runs every
+    `every` seconds (once, for every=0); a failing job is logged and tried
+    again at its next slot. Started after fork: gunicorn's post_worker_init
+    hook, with the first request as a fallback."""
+
+    def __init__(self):
+        self.jobs  = []               # (first run offset, every, name, fn)
+        self.pid   = None
+        self.lock  = threading.Lock()
+        self.stats = {}               # name → {"runs", "errors", "secs"}
+
+    def every(self, seconds, fn, name=None, first=None):
+        name = name or fn.__name__
+        self.jobs.append((seconds if first is None else first, seconds, name, fn))
+        self.stats[name] = {"runs": 0, "errors": 0, "secs": 0.0}
+
+    def start(self):
+        if self.pid == os.getpid(): return
+        with self.lock:
+            if self.pid == os.getpid(): return
+            t0 = time.monotonic()
+            jobs = [[t0 + first, every, name, fn] for first, every, name, fn in self.jobs]
+            if jobs: threading.Thread(target=self._run, args=(jobs,), daemon=True).start()
+            self.pid = os.getpid()
+
+    def _run(self, jobs):
+        while True:
+            job = min(jobs, key=lambda j: j[0])
+            time.sleep(max(0.0, job[0] - time.monotonic()))
+            due, every, name, fn = job
+            t0, st = time.perf_counter(), self.stats[name]
+            try: fn()
+            except Exception as e:
+                st["errors"] += 1
+                logger.error(f"{name} error: {e}")
+            st["runs"] += 1
+            st["secs"] += time.perf_counter() - t0
+            if every: job[0] = max(due + every, time.monotonic())
+            else: jobs.remove(job)
+            if not jobs: return
+
+def warmup():
+    """Do now what the first requests would otherwise pay for: question Flex
+    messages, search postings, reply serialization and a pooled connection to
+    the Messaging API. Yields between steps so requests interleave."""
+    t0, snap = time.perf_counter(), cm.snap
+    for g in snap.game_models:
+        for q in range(len(g.questions)): g.message(q)
+        time.sleep(0)
+    for cat in SEARCH_FIELDS:
+        snap.index[cat]; time.sleep(0)
+    menu_wire(False); menu_wire(True)
+    prerender()
+    prime_api()
+    logger.info(f"warmup done in {(time.perf_counter() - t0) * 1e3:.0f} ms")
+
+def prerender(slice_secs=0.002):
+    """Fill the payload cache with the content replies, until the budget is
+    used up. Runs after load and after each content reload, so it yields to
+    requests every `slice_secs` of work."""
+    snap = cm.snap
+    def builds():
+        for data in TEXT_CONTENT.values():
+            for x in data(): yield text_payload(x if isinstance(x, str) and x else "—")
+        for q in snap.quotes: yield text_payload(_quote_text(q))
+        for flex, hint, answer, items in ((riddle_flex, riddle_hint_flex, riddle_answer_flex, snap.riddles),
+                                          (deen_flex, deen_hint_flex, deen_answer_flex, snap.religion)):
+            for i, x in enumerate(items):
+                yield flex(x, i + 1, len(items))
+                yield hint(x.hint, x.question)
+                yield answer(x.answer, x.question)
+        for g in snap.game_models:
+            for r in g.results: yield result_flex(r)
+        for name, (data, fmt) in BATCH.items():                 # "<command> N" carousel bubbles
+            for x in data(): yield item_bubble(name, fmt(x))
+    t = time.perf_counter()
+    for _ in builds():
+        if payloads.full(): break
+        if time.perf_counter() - t >= slice_secs:
+            time.sleep(0); t = time.perf_counter()
+
+def prime_api():
+    """Open (or keep open) a pooled connection to the Messaging API with a
+    side-effect-free call; the answer itself doesn't matter."""
+    try: line_api().get_bot_info(_request_timeout=LINE_TIMEOUT)
+    except Exception as e: logger.debug(f"api prime: {e}")
+
+def ping_self():
+    # keeps an idle free-tier instance (Render) from being spun down
+    requests.get(SELF_URL + "/health", timeout=5)
+
+SELF_URL = os.getenv("RENDER_EXTERNAL_URL", "")
+if SELF_URL and not SELF_URL.startswith("http"): SELF_URL = "https://" + SELF_URL
+
+scheduler = Scheduler()
+if os.getenv("WARMUP", "1") == "1": scheduler.every(0, warmup, first=0)
+if int(os.getenv("CONTENT_WATCH", 30)) > 0: scheduler.every(int(os.getenv("CONTENT_WATCH", 30)), check_content)
+if journal is not None: scheduler.every(journal.every, journal.flush, "state_flush")
+if int(os.getenv("SESSION_SWEEP", 300)) > 0:
+    scheduler.every(int(os.getenv("SESSION_SWEEP", 300)), lambda: cm.sessions.sweep(), "session_sweep")
+if float(os.getenv("LINE_POOL_PING", 240)) > 0:
+    scheduler.every(float(os.getenv("LINE_POOL_PING", 240)), prime_api)
+if SELF_URL: scheduler.every(600, ping_self)
+if METRICS_DIR: scheduler.every(METRICS_EVERY, write_metrics, "metrics")
+
+app.before_request(scheduler.start)   # no-op once running in this process
+if profiler is not None: app.before_request(profiler.start)
 
 if __name__ == "__main__":
-    if os.getenv("RENDER_EXTERNAL_URL"):
-        threading.Thread(target=keep_alive, daemon=True).start()
+    if sys.argv[1:2] == ["build-snapshot"]:
+        logger.info(f"wrote {write_snapshot(*sys.argv[2:3])}"); sys.exit()
+    scheduler.start()
+    if profiler is not None: profiler.start()
     app.run(host="0.0.0.0", port=int(os.getenv("PORT",5000)))
@@ -0,0 +1,836 @@
+"""Micro-benchmarks for the bot's hot paths.
+
+    python bench.py            # run everything
+    python bench.py rotation   # run one benchmark by name
+"""
+import base64, hashlib, hmac, json, os, random, shlex, signal, ssl, subprocess, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+os.environ.setdefault("STATE_DB", "")                 # benches journal explicitly
+
+import app
+from linebot.v3.messaging import TextMessage
+
+BENCHES = {}
+
+def bench(fn):
+    BENCHES[fn.__name__] = fn
+    return fn
+
+def _txt(text):
+    """A text reply as the SDK model, the baseline the wire forms are measured against."""
+    return TextMessage(text=str(text))
+
+def timeit(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n): fn()
+    return (time.perf_counter() - t0) / n
+
+def report(label, sec):
+    print(f"  {label:<34} {sec * 1e6:10.2f} µs/op")
+
+# ═══════════════════════════ ROTATION ════════════════════════════════
+def _legacy_get_random(used, data):
+    """ContentManager.get_random as it was before the shuffle bag."""
+    if len(used) >= len(data): used.clear()
+    avail = [i for i in range(len(data)) if i not in used]
+    idx = random.choice(avail)
+    used.append(idx)
+    return data[idx]
+
+@bench
+def rotation():
+    data = app.cm.files["سؤال"]
+    n    = len(data)
+    print(f"rotation over questions.txt (n={n}, one full pass)")
+    used = []
+    report("legacy list scan", timeit(lambda: _legacy_get_random(used, data), n))
+    rot = app.RotationStore()
+    report("per-chat seed+cursor", timeit(lambda: data[rot.draw("C1", "سؤال", n)], n))
+    rot = app.RotationStore()
+    chats = [f"C{i}" for i in range(10000)]
+    report("per-chat, 10k chats", timeit(lambda: rot.draw(random.choice(chats), "سؤال", n), 50000))
+
+@bench
+def concurrency():
+    """Hammer draws, session updates and rate checks from many threads while
+    content is force-reloaded underneath; check every pass is still a permutation."""
+    threads, per = int(os.getenv("BENCH_THREADS", 8)), int(os.getenv("BENCH_DRAWS", 20000))
+    keys   = ("سؤال", "تحدي", "لغز")
+    chats  = [f"C{i}" for i in range(4)] + [f"C{i}" for i in range(4, 400)]
+    m, errors, drawn = app.ContentManager(), [], {}
+    m.initialize()
+    m.sessions = app.MemorySessionStore()
+    limit, seen, stop = app.TokenBuckets(1e9, 1e9), app.RecentIds(1000), threading.Event()
+    sizes = {k: len({"سؤال": m.files["سؤال"], "تحدي": m.files["تحدي"], "لغز": m.riddles}[k]) for k in keys}
+
+    def work(t):
+        rnd, out = random.Random(t), {}
+        try:
+            for i in range(per):
+                chat = chats[rnd.randrange(4)] if i % 2 else rnd.choice(chats)   # half on 4 hot chats
+                key  = keys[i % 3]
+                data = m.riddles if key == "لغز" else m.files[key]           # whatever snapshot is current
+                idx, item = m.draw(key, data, chat)
+                assert app.item_text(item) == app.item_text(data[idx])   # packed items decode per access
+                out.setdefault((chat, key), []).append(idx)
+                m.sessions.update(f"game:{chat}", lambda s: {"p": (s or {"p": 0})["p"] + 1})
+                limit.allow(chat, i); seen.seen(f"{t}:{i}")
+        except Exception as e:
+            errors.append(repr(e))
+        drawn[t] = out
+
+    def reloader():
+        while not stop.is_set():
+            m.reload(force=True); time.sleep(0.005)
+
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)                 # switch threads as often as possible
+    try:
+        r = threading.Thread(target=reloader); r.start()
+        t0 = time.perf_counter()
+        ws = [threading.Thread(target=work, args=(t,)) for t in range(threads)]
+        for w in ws: w.start()
+        for w in ws: w.join()
+        wall = time.perf_counter() - t0
+        stop.set(); r.join()
+    finally:
+        sys.setswitchinterval(switch)
+    merged = {}
+    for out in drawn.values():
+        for k, v in out.items(): merged.setdefault(k, []).extend(v)
+    bad = 0
+    for (chat, key), idx in merged.items():        # every full pass holds each index once
+        n = sizes[key]
+        counts = {}
+        for i in idx: counts[i] = counts.get(i, 0) + 1
+        full = len(idx) // n
+        bad += sum(1 for c in counts.values() if c not in (full, full + 1))
+    games = sum(m.sessions.get(f"game:{c}")["p"] for c in chats if m.sessions.get(f"game:{c}"))
+    total = threads * per
+    print(f"{threads} threads x {per} draws over {len(merged)} chat/category rotations, "
+          f"content force-reloaded every 5 ms")
+    print(f"  {total / wall:10.0f} draws/s   errors {len(errors)}   rotation repeats {bad}   "
+          f"lost session updates {total - games}")
+    for e in errors[:3]: print("   ", e)
+    if errors or bad or total != games:
+        sys.exit(f"concurrency: {len(errors)} errors, {bad} rotation repeats, "
+                 f"{total - games} lost session updates")
+
+# ═══════════════════════════ STARTUP ═════════════════════════════════
+STARTUP = """
+import os, time, app
+def statm():
+    f = open("/proc/self/statm").read().split()
+    page = os.sysconf("SC_PAGE_SIZE")
+    return int(f[1]) * page, (int(f[1]) - int(f[2])) * page    # resident, private
+app.SNAPSHOT_PATH = {path!r}
+(r0, p0), t0 = statm(), time.perf_counter()
+m = app.ContentManager(); m.initialize()
+t1 = time.perf_counter()
+for k in m.SOURCES:                                             # touch every item once
+    v = getattr(m, k)
+    if not isinstance(v, dict): n = sum(1 for _ in v)
+r1, p1 = statm()
+print(t1 - t0, r1 - r0, p1 - p0)
+"""
+
+@bench
+def startup():
+    path = os.path.join(tempfile.mkdtemp(), "content.snap")
+    app.write_snapshot(path)
+    print(f"content load in a fresh process ({os.path.getsize(path) // 1024} KiB snapshot)")
+    env = {**os.environ, "CONTENT_SNAPSHOT": "", "CONTENT_WATCH": "0"}
+    for label, p in (("parse text/JSON files", ""), ("mmap snapshot", path)):
+        out = subprocess.run([sys.executable, "-c", STARTUP.format(path=p)], env=env,
+                             capture_output=True, text=True, check=True).stdout.split()
+        sec, rss, private = float(out[0]), int(out[1]), int(out[2])
+        print(f"  {label:<22} {sec * 1e3:8.2f} ms  RSS +{rss / 2**20:6.2f} MiB"
+              f"  private +{private / 2**20:6.2f} MiB")
+
+# ═══════════════════════════ SESSIONS ════════════════════════════════
+@bench
+def sessions():
+    n = 5000
+    print(f"session store, hot-path lookup and one answer step ({n} ops)")
+    db = os.path.join(tempfile.mkdtemp(), "sessions.db")
+    for name, store in (("memory", app.MemorySessionStore()),
+                        ("sqlite (WAL)", app.SQLiteSessionStore(db))):
+        store.set("game:U1", {"game": 0, "p": 0, "b": 3})
+        keys = ["game:U1", "riddle:U1", "deen:U1"]
+        report(f"{name} get_many x3", timeit(lambda: store.get_many(keys), n))
+        report(f"{name} update", timeit(
+            lambda: store.update("game:U1", lambda s: {**s, "p": s["p"] + 1}), n))
+
+# ═══════════════════════════ HANDLE ══════════════════════════════════
+CHATTER = ["هههههه", "صباح الخير", "وش رايكم نطلع اليوم؟", "تمام", "😂😂",
+           "مين جاي بكرة", "الله يسعدك", "ok", "لا والله", "شفتوا المباراة امس؟",
+           "وينكم يا جماعة", "انا مشغول الحين", "👍", "يب", "تصبحون على خير"]
+COMMANDS = ["سؤال", "تحدي", "اعتراف", "منشن", "موقف", "اقتباس", "قصة",
+            "لو كنت", "أيهما أصعب", "لغز", "تلميح", "جواب", "مساعدة"]
+
+def group_mix(n, users=200, groups=20, chatter=0.85, seed=7):
+    """A group-chat stream: mostly chatter, the rest commands and game answers."""
+    from types import SimpleNamespace as NS
+    rnd, out = random.Random(seed), []
+    for _ in range(n):
+        r = rnd.random()
+        text = rnd.choice(CHATTER) if r < chatter else \
+               rnd.choice(["أ", "ب", "ج", "1"]) if r < chatter + 0.03 else rnd.choice(COMMANDS)
+        out.append(NS(reply_token="t", message=NS(text=text),
+                      source=NS(user_id=f"U{rnd.randrange(users)}", group_id=f"G{rnd.randrange(groups)}")))
+    return out
+
+@bench
+def handle():
+    events = group_mix(20000)
+    sent   = [0]
+    app.user_limit.rate = app.chat_limit.rate = 0                  # measure full handling
+    real, app.reply = app.reply, lambda token, msgs, secondary=False: sent.__setitem__(0, sent[0] + 1)
+    try:
+        it = iter(events * 2)
+        for e in events: app.handle(e)                      # warm up sessions and caches
+        sent[0] = 0
+        print(f"handle() over a replayed group-chat mix ({len(events)} messages)")
+        report("per message (reply stubbed)", timeit(lambda: app.handle(next(it)), len(events)))
+        print(f"  {'':<34} {sent[0]:10d} replies")
+        quiet = [e for e in group_mix(20000, chatter=1.0, seed=8)]
+        for e in quiet: e.source.user_id = "Q" + e.source.user_id      # no session open
+        it = iter(quiet)
+        report("chatter, no session open", timeit(lambda: app.handle(next(it)), len(quiet)))
+    finally:
+        app.reply = real
+
+@bench
+def commands():
+    print(f"Command matching ({len(app.COMMAND_KEYS)} normalized keys)")
+    exact, variant, chatter = "أيهما أصعب", "ايّهما اصـعب 😂", "وش رايكم نطلع اليوم؟"
+    report("exact hit (dict lookup)", timeit(lambda: app.COMMANDS.get(exact), 200000))
+    report("variant: command_key() + lookup", timeit(lambda: app.COMMAND_KEYS.get(app.command_key(variant)), 200000))
+    report("chatter miss: command_key(heads)", timeit(lambda: app.command_key(chatter, app.COMMAND_HEADS), 200000))
+
+# ═══════════════════════════ STATE JOURNAL ═══════════════════════════
+@bench
+def state():
+    events, per_flush = group_mix(30000), int(os.getenv("BENCH_FLUSH_EVERY", 300))
+    app.user_limit.rate = app.chat_limit.rate = 0
+    real, app.reply = app.reply, lambda token, msgs, secondary=False: None
+    rot, ses = app.cm.used, app.cm.sessions
+    try:
+        for e in events: app.handle(e)                          # warm up
+        it = iter(events); plain = timeit(lambda: app.handle(next(it)), len(events))
+        path = os.path.join(tempfile.mkdtemp(), "state.db")
+        j = app.StateJournal(path, rot, ses)
+        j._conn().execute("PRAGMA wal_autocheckpoint=0")        # keep every frame in the WAL to count it
+        i, t0 = 0, time.perf_counter()
+        for e in events:
+            app.handle(e); i += 1
+            if i % per_flush == 0: j.flush()
+        journaled = (time.perf_counter() - t0 - j.stats["flush_secs"]) / len(events)
+        j.flush()
+        wal = os.path.getsize(path + "-wal")
+    finally:
+        app.reply = real
+        rot.changed = ses.changed = None
+    st = j.snapshot()
+    print(f"State journal over a replayed group-chat mix ({len(events)} messages, flush every {per_flush})")
+    report("handle() without journal", plain)
+    report("handle() journaled (flushes excluded)", journaled)
+    print(f"  changes {st['changes']}, rows written {st['rows']} in {st['flushes']} flushes "
+          f"(write amplification {st['write_amplification']}), WAL {wal / 2**20:.2f} MiB "
+          f"= {wal / st['changes']:.0f} B/change")
+    report("flush (per flush, off the request path)", st["flush_secs"] / st["flushes"])
+    for chats in (1000, 50000):
+        big = os.path.join(tempfile.mkdtemp(), "state.db")
+        r, s = app.RotationStore(max_chats=chats), app.MemorySessionStore()
+        j = app.StateJournal(big, r, s)
+        for c in range(chats):
+            for k in app.ROTATION_KEYS[:4]: r.draw(f"C{c}", k, 300)
+            if c % 3 == 0: s.set(f"game:U{c}", {"game": 1, "p": 0x2c5, "b": 3})
+        j.flush()
+        r2, s2 = app.RotationStore(max_chats=chats), app.MemorySessionStore()
+        n = app.StateJournal(big, r2, s2).restore()
+        assert r2.dump(f"C{chats - 1}") == r.dump(f"C{chats - 1}")
+        t = timeit(lambda: app.StateJournal(big, app.RotationStore(max_chats=chats),
+                                            app.MemorySessionStore()).restore(), 3)
+        size = os.path.getsize(big) + os.path.getsize(big + "-wal")
+        print(f"  restore {n:6d} chats+sessions ({size / 2**20:5.2f} MiB) {t * 1e3:10.1f} ms")
+
+# ═══════════════════════════ GAMES ═══════════════════════════════════
+def _legacy_result(answers, game_idx):
+    counts = {"أ": 0, "ب": 0, "ج": 0}
+    for a in answers:
+        if a in counts: counts[a] += 1
+    if not any(counts.values()):
+        return "شخصيتك مميزة ومختلفة"
+    max_val  = max(counts.values())
+    top_keys = [k for k, v in counts.items() if v == max_val]
+    key = top_keys[0] if len(top_keys) == 1 else \
+          next((a for a in answers if a in top_keys), top_keys[0])
+    return app.cm.results.get(f"لعبة{game_idx + 1}", {}).get(key, "شخصيتك مميزة ومختلفة")
+
+@bench
+def games():
+    rnd, models = random.Random(5), app.cm.game_models
+    runs = [(i, [rnd.choice("أبج") for _ in g.questions]) for i, g in enumerate(models) for _ in range(2000)]
+    bad = sum(models[i].result(models[i].replay(a)) != _legacy_result(a, i) for i, a in runs)
+    print(f"Personality games: {len(runs)} random plays over {len(models)} games, {bad} results differ from before")
+    g, raw, answers = models[0], app.cm.games[0], runs[0][1]
+    def legacy_play():
+        s = {"game": 0, "q": 0, "answers": []}
+        for a in answers:
+            s["answers"].append(a); s["q"] += 1
+            if s["q"] < len(raw["questions"]):
+                q = s["q"]
+                app.question_flex(raw["title"], raw["questions"][q], f"{q + 1}/{len(raw['questions'])}")
+        return _legacy_result(s["answers"], 0)
+    def play():
+        s = {"game": 0, "p": 0, "b": g.bits}
+        for a in answers:
+            p = g.answer(s["p"], a)
+            if not g.done(p):
+                s["p"] = p; g.message(g.step(p))
+        return g.result(p)
+    print(f"  full play of '{g.title}' ({len(answers)} answers), per answer:")
+    report("answer lists + question_flex()", timeit(legacy_play, 2000) / len(answers))
+    report("packed progress + cached message", timeit(play, 2000) / len(answers))
+    w = app.Game({"questions": [{"question": "q", "options": {
+             "أ": {"text": "a", "scores": {"x": 2, "y": 1}}, "ب": {"text": "b", "weight": 3},
+             "ج": "c", "د": "d"}}] * 6}, {"x": "X", "y": "Y", "ب": "B", "ج": "C", "د": "D"})
+    print(f"  weighted 4-option game: {w.bits}-bit fields, "
+          f"أأببجد → {w.result(w.replay('أأببجد'))}, دجججأ → {w.result(w.replay('دجججأ'))}")
+
+# ═══════════════════════════ FLEX ════════════════════════════════════
+@bench
+def flex():
+    r, q = app.cm.riddles[0], app.cm.games[0]["questions"][0]
+    n    = 500
+    print(f"Flex reply body (message, quick reply, JSON), validated every time vs cached ({n} renders)")
+
+    def sent(msg):
+        """What reply() and _send() make of one message."""
+        msg = msg.with_menu(app.menu_wire(False)) if isinstance(msg, app.Wire) else \
+              msg.copy(update={"quick_reply": app.make_menu(False)})
+        return app.reply_body("t", [msg])
+
+    screens = {
+        "welcome":  (app._build_welcome, app.welcome_flex),
+        "help":     (app._build_help,    app.help_flex),
+        "menu":     (lambda: app.Wire(app._dumps(app.line_api().api_client.sanitize_for_serialization(
+                         app._build_menu(app.MENU_A)))), lambda: app.Wire(app.menu_wire(False))),
+        "riddle":   (lambda: app.flex_msg(app._riddle_bubble(r.question, "1/5")["body"]["contents"]),
+                     lambda: app.riddle_flex(r, 1, 5)),
+        "question": (lambda: app.FlexMessage(alt_text=app.ALT_TEXT, contents=app.FlexContainer.from_dict(
+                         app._question_bubble("t", q["question"], "1/5",
+                                              *[x for k, v in q["options"].items() for x in (f"{k}. {v}", k)]))),
+                     lambda: app.cm.game_models[0].message(0)),
+        "result":   (lambda: app.flex_msg(app._result_bubble("res")["body"]["contents"], app.footer_credit()),
+                     lambda: app.result_flex("res")),
+    }
+    for name, (old, new) in screens.items():
+        if name == "menu": a, b = timeit(old, n), timeit(new, n)     # a quick reply, not a message
+        else: a, b = timeit(lambda: sent(old()), n), timeit(lambda: sent(new()), n)
+        print(f"  {name:<10} {1 / a:10.0f} msg/s -> {1 / b:10.0f} msg/s")
+
+@bench
+def batch():
+    """N single `سؤال` replies vs one `سؤال N` carousel, through the pooled client
+    against a local stub: the CPU part (draw + render + reply body) with the
+    payload cache cold and warm, and the whole reply, per item."""
+    data, rot = app.cm.files["سؤال"], app.RotationStore()
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubLineAPI)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    app.configuration._base_path = f"http://127.0.0.1:{stub.server_address[1]}"
+    body = lambda msgs: app.reply_body("t", msgs)
+    send = lambda msgs: app._send("t", msgs)
+    one  = lambda: [app.text_payload(data[rot.draw("C1", "سؤال", len(data))])]
+    many = lambda n: [app.carousel_flex("سؤال", [data[i] for i in rot.draw_many("C1", "سؤال", len(data), n)])]
+    budget = app.payloads.budget
+    print("question rounds, per item: N single replies vs one N-item carousel (local stub API)")
+    try:
+        for n in (3, 5, 10):
+            app.payloads.budget, app.payloads.size = 0, 0
+            app.payloads.data.clear()
+            cold1 = timeit(lambda: [body(one()) for _ in range(n)], 100) / n
+            coldN = timeit(lambda: body(many(n)), 100) / n
+            app.payloads.budget = budget
+            for _ in range(len(data) + 1): one()                       # a full pass: all cached
+            for _ in range(len(data) // n + 2): many(n)
+            warm1 = timeit(lambda: [body(one()) for _ in range(n)], 200) / n
+            warmN = timeit(lambda: body(many(n)), 200) / n
+            all1 = timeit(lambda: [send(one()) for _ in range(n)], 100) / n
+            allN = timeit(lambda: send(many(n)), 100) / n
+            print(f"  N={n:<3} cpu cold {cold1 * 1e6:7.1f} -> {coldN * 1e6:7.1f}  warm {warm1 * 1e6:5.1f} -> "
+                  f"{warmN * 1e6:5.1f} µs/item   reply {all1 * 1e6:6.1f} -> {allN * 1e6:6.1f} µs/item   "
+                  f"API calls {n} -> 1")
+    finally:
+        stub.shutdown()
+        app.payloads.budget = budget
+
+@bench
+def payloads():
+    """Reply body for common replies: SDK models + serialization vs cached wire forms."""
+    from linebot.v3.messaging import ReplyMessageRequest
+    san = app.line_api().api_client.sanitize_for_serialization
+    snap, r = app.cm.snap, app.cm.riddles[0]
+    def model_body(msgs, secondary=False):
+        msgs[-1] = msgs[-1].copy(update={"quick_reply": app.make_menu(secondary)})
+        return json.dumps(san(ReplyMessageRequest(reply_token="t", messages=msgs))).encode()
+    def wire_body(msgs, secondary=False):
+        msgs[-1] = msgs[-1].with_menu(app.menu_wire(secondary))
+        return app.reply_body("t", msgs)
+    q = snap.quotes[0]
+    cases = {
+        "text":   (lambda: [_txt(snap.questions[7])], lambda: [app.text_payload(snap.questions[7])]),
+        "quote":  (lambda: [_txt(app._quote_text(q))], lambda: [app.text_payload(app._quote_text(q))]),
+        "riddle": (lambda: [app.FLEX["riddle"].render(question=r.question, progress="1/148")],
+                   lambda: [app.riddle_flex(r, 1, 148)]),
+        "result": (lambda: [app.FLEX["result"].render(result_text=snap.game_models[0].results[0])],
+                   lambda: [app.result_flex(snap.game_models[0].results[0])]),
+    }
+    print("reply body per call: message models + SDK serialization vs payload cache")
+    for name, (old, new) in cases.items():
+        report(f"{name:<7} models", timeit(lambda: model_body(old()), 300))
+        report(f"{name:<7} cached wire", timeit(lambda: wire_body(new()), 3000))
+    cache = app.payloads
+    cache.data.clear(); cache.size = 0
+    t0 = time.perf_counter(); app.prerender(); dt = time.perf_counter() - t0
+    st = cache.stats()
+    print(f"  prerender: {st['entries']} payloads, {st['bytes'] / 2**20:.2f} MiB of "
+          f"{st['budget'] / 2**20:.0f} MiB budget, {dt * 1e3:.0f} ms")
+    real, app.reply = app.reply, lambda token, msgs, secondary=False: None
+    app.user_limit.rate = app.chat_limit.rate = 0
+    try:
+        app.PAYLOAD_N.series.clear()
+        for e in group_mix(20000): app.handle(e)
+    finally:
+        app.reply = real
+    print(f"  hit rate over a 20k-message group mix after prerender: {cache.stats()['hit_rate']}")
+
+# ═══════════════════════════ SEARCH ══════════════════════════════════
+@bench
+def search():
+    snap = app.cm.snap
+    print("Keyword search: index build per category (first lookup) and filtered draw")
+    total = 0.0
+    for cat, field in app.SEARCH_FIELDS.items():
+        data = getattr(snap, field)
+        t0 = time.perf_counter(); post = app.build_index(data); dt = time.perf_counter() - t0
+        total += dt
+        print(f"  {cat:<12} {len(data):5} items {len(post):6} terms {dt * 1e3:8.2f} ms")
+    print(f"  {'all':<12} {total * 1e3:38.2f} ms")
+    for q in ("الحب", "حب صديق", "الصداقه", "zzz"):
+        hits = len(app.lookup(snap.index["سؤال"], q) or ())
+        report(f"draw_matching سؤال {q!r} ({hits} hits)", timeit(lambda: app.cm.draw_matching("سؤال", q), 20000))
+    report("search all categories 'حياة'", timeit(lambda: app.cm.search("حياة"), 2000))
+
+# ═══════════════════════════ LINE API STUB ═══════════════════════════
+class StubLineAPI(BaseHTTPRequestHandler):
+    """Answers every Messaging API call with a minimal successful response."""
+    protocol_version = "HTTP/1.1"          # keep-alive, like api.line.me
+    disable_nagle_algorithm = True
+    connections = 0
+    calls       = 0
+    BODY = b'{"sentMessages":[{"id":"1","quoteToken":"q"}]}'
+
+    def setup(self):
+        type(self).connections += 1
+        super().setup()
+
+    def do_POST(self):
+        type(self).calls += 1
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.BODY)))
+        self.end_headers()
+        self.wfile.write(self.BODY)
+
+    def do_GET(self):                      # get_bot_info, used to prime the pool
+        type(self).calls += 1
+        body = b'{"userId":"U0","basicId":"@bench","displayName":"bench","chatMode":"bot","markAsReadMode":"auto"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a): pass
+
+def stub_https_server():
+    """Start StubLineAPI over TLS with a throwaway self-signed cert.
+    Returns (base_url, ca_cert_path)."""
+    d = tempfile.mkdtemp()
+    crt, key = os.path.join(d, "stub.crt"), os.path.join(d, "stub.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                    "-keyout", key, "-out", crt, "-days", "1", "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost"],
+                   check=True, capture_output=True)
+    srv = ThreadingHTTPServer(("localhost", 0), StubLineAPI)
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(crt, key)
+    srv.socket = ctx.wrap_socket(srv.socket, server_side=True)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return f"https://localhost:{srv.server_address[1]}", crt
+
+@bench
+def api_client():
+    from linebot.v3.messaging import ApiClient, MessagingApi, ReplyMessageRequest
+    url, ca = stub_https_server()
+    app.configuration._base_path, app.configuration.ssl_ca_cert = url, ca
+    app._api = None             # built at import (build_flex_cache): rebuild it with the stub's CA
+    req = lambda: ReplyMessageRequest(reply_token="t", messages=[_txt("hi")])
+    n   = 200
+    print(f"reply_message against a local TLS stub ({n} replies)")
+
+    def fresh():
+        with ApiClient(app.configuration) as api:
+            MessagingApi(api).reply_message(req())
+    StubLineAPI.connections = 0
+    report("new ApiClient per reply", timeit(fresh, n))
+    print(f"  {'':<34} {StubLineAPI.connections:10d} TLS handshakes")
+
+    StubLineAPI.connections = 0
+    report("pooled line_api()", timeit(
+        lambda: app.line_api().reply_message(req(), _request_timeout=app.LINE_TIMEOUT), n))
+    print(f"  {'':<34} {StubLineAPI.connections:10d} TLS handshakes")
+
+# ═══════════════════════════ WEBHOOK LOAD ════════════════════════════
+def sign(body, secret):
+    return base64.b64encode(hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+def deliveries(n, secret, seed=11):
+    """n signed webhook bodies, each a batch of 1-5 message events from group_mix()."""
+    rnd, events, out = random.Random(seed), group_mix(n * 3, users=2000, groups=300, seed=seed), []
+    while len(out) < n:
+        batch = [events.pop() for _ in range(min(len(events), rnd.choice((1, 1, 1, 2, 3, 5))))]
+        if not batch: break
+        body = json.dumps({"destination": "Ubench", "events": [{
+            "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+            "webhookEventId": f"E{rnd.getrandbits(64):x}",
+            "deliveryContext": {"isRedelivery": False},
+            "source": {"type": "group", "groupId": e.source.group_id, "userId": e.source.user_id},
+            "replyToken": f"r{rnd.getrandbits(64):x}",
+            "message": {"type": "text", "id": "1", "text": e.message.text, "quoteToken": "q"},
+        } for e in batch]}, ensure_ascii=False)
+        out.append((body, sign(body, secret)))
+    return out
+
+def worker_rss(master):
+    """Total VmRSS (bytes) of the gunicorn master's child processes."""
+    total = 0
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as fh:
+                if int(fh.read().rsplit(")", 1)[1].split()[1]) != master: continue
+            with open(f"/proc/{pid}/status") as fh:
+                total += next(int(l.split()[1]) for l in fh if l.startswith("VmRSS")) * 1024
+        except (OSError, StopIteration, ValueError):
+            pass
+    return total
+
+def procfile_cmd(port, workers=None):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Procfile")) as fh:
+        web = next(l.split(":", 1)[1] for l in fh if l.startswith("web:"))
+    cmd = shlex.split(web.replace("$PORT", str(port)).replace("0.0.0.0", "127.0.0.1"))
+    if workers: cmd[cmd.index("--workers") + 1] = str(workers)
+    return web, cmd
+
+def pct(xs, p):
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+@bench
+def webhook():
+    """Replay signed deliveries at the Procfile's gunicorn+gevent command."""
+    import requests
+    n, conc, secret = int(os.getenv("BENCH_DELIVERIES", 3000)), int(os.getenv("BENCH_CONCURRENCY", 32)), "bench"
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubLineAPI)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    port = int(os.getenv("BENCH_PORT", 18080))
+    web, cmd = procfile_cmd(port)
+    env = {"RATE_USER_PER_SEC": "0", "RATE_CHAT_PER_SEC": "0",     # measure full handling
+           **os.environ, "LINE_CHANNEL_SECRET": secret, "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+           "LINE_API_HOST": f"http://127.0.0.1:{stub.server_address[1]}", "CONTENT_WATCH": "0",
+           "STATE_DB": os.path.join(tempfile.mkdtemp(), "state.db")}
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url, http = f"http://127.0.0.1:{port}", requests.Session()
+    http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=conc))
+    try:
+        for _ in range(60):                                          # wait for workers to boot
+            try:
+                http.get(url + "/health", timeout=5); break
+            except requests.RequestException:
+                time.sleep(0.5)
+        work = deliveries(n, secret)
+        post = lambda d: http.post(url + "/callback", data=d[0].encode(), timeout=30,
+                                   headers={"X-Line-Signature": d[1], "Content-Type": "application/json"})
+        with ThreadPoolExecutor(conc) as pool:
+            list(pool.map(post, work[:min(200, len(work))]))            # warm up every worker
+        rss0, StubLineAPI.calls, lat, codes = worker_rss(proc.pid), 0, [], {}
+        def timed(d):
+            t = time.perf_counter()
+            r = post(d)
+            lat.append(time.perf_counter() - t)
+            codes[r.status_code] = codes.get(r.status_code, 0) + 1
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(conc) as pool:
+            list(pool.map(timed, work))
+        wall, rss1 = time.perf_counter() - t0, worker_rss(proc.pid)
+    finally:
+        proc.terminate(); proc.wait(10); stub.shutdown()
+    lat.sort()
+    events = sum(b.count('"webhookEventId"') for b, _ in work)
+    print(f"/callback under `{web.strip().split()[0]} ... {' '.join(cmd[cmd.index('--workers'):][:2])}`, "
+          f"{len(work)} deliveries ({events} events), concurrency {conc}")
+    print(f"  throughput          {len(work) / wall:10.1f} deliveries/s  {events / wall:10.1f} events/s")
+    print(f"  latency p50/p95/p99 {pct(lat, .5) * 1e3:7.2f} / {pct(lat, .95) * 1e3:.2f} / {pct(lat, .99) * 1e3:.2f} ms")
+    print(f"  status codes        {codes}   reply API calls {StubLineAPI.calls}")
+    print(f"  worker RSS          {rss0 / 2**20:.1f} MiB -> {rss1 / 2**20:.1f} MiB ({(rss1 - rss0) / 2**20:+.1f} MiB)")
+
+# ═══════════════════════════ WARMUP ══════════════════════════════════
+@bench
+def warmup():
+    """First-request latency of a fresh gunicorn worker, with and without warmup."""
+    import requests
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubLineAPI)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    port, secret = int(os.getenv("BENCH_PORT", 18080)), "bench"
+    _, cmd = procfile_cmd(port, workers=1)
+    texts = ["1", "مساعدة", "لغز", "سؤال: الحب", "اقتباس", "تحدي"]
+    bodies = [json.dumps({"destination": "U0", "events": [{
+        "type": "message", "mode": "active", "timestamp": 0, "webhookEventId": f"W{i}",
+        "deliveryContext": {"isRedelivery": False}, "replyToken": f"r{i}",
+        "source": {"type": "group", "groupId": "G1", "userId": f"U{i}"},
+        "message": {"type": "text", "id": str(i), "quoteToken": "q", "text": t}}]}, ensure_ascii=False)
+        for i, t in enumerate(texts * 4)]
+    print(f"first /callback replies of a fresh worker (`{' '.join(cmd[:2])} ... --workers 1`), ms")
+    for label, on in (("no warmup", "0"), ("warmup", "1")):
+        env = {"RATE_USER_PER_SEC": "0", "RATE_CHAT_PER_SEC": "0", **os.environ, "WARMUP": on,
+               "LINE_CHANNEL_SECRET": secret, "LINE_CHANNEL_ACCESS_TOKEN": "bench", "STATE_DB": "",
+               "LINE_API_HOST": f"http://127.0.0.1:{stub.server_address[1]}", "CONTENT_WATCH": "0"}
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        try:
+            for line in proc.stderr:                         # worker forked; give it time to boot
+                if "Booting worker" in line: break
+            time.sleep(float(os.getenv("BENCH_BOOT_WAIT", 4)))
+            lat = []
+            for b in bodies:
+                t0 = time.perf_counter()
+                r = requests.post(f"http://127.0.0.1:{port}/callback", data=b.encode(), timeout=30,
+                                  headers={"X-Line-Signature": sign(b, secret), "Content-Type": "application/json"})
+                lat.append((time.perf_counter() - t0) * 1e3)
+                assert r.status_code == 200, r.status_code
+        finally:
+            proc.terminate(); proc.wait(10)
+        first = "  ".join(f"{x:6.1f}" for x in lat[:len(texts)])
+        print(f"  {label:<10} first {texts!r}: {first}   later median {sorted(lat[len(texts):])[len(lat[len(texts):]) // 2]:.1f}")
+    stub.shutdown()
+
+# ═══════════════════════════ PROFILING ═══════════════════════════════
+@bench
+def profiling():
+    """handle_delivery() against a local stub with the slow-request trace and
+    the sampling profiler off and on; the cost of each, and what they report."""
+    import logging
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubLineAPI)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    app.configuration._base_path = f"http://127.0.0.1:{stub.server_address[1]}"
+    app.user_limit.rate = app.chat_limit.rate = 0                  # measure full handling
+    n, rounds, slow, prof = int(os.getenv("BENCH_DELIVERIES", 3000)), 6, app.SLOW_MS, app.profiler
+    work = iter(deliveries(n * (rounds * 4 + 2), "bench", seed=5))  # fresh event ids: no dedup drops
+    run  = lambda: app.handle_delivery(*next(work))
+    for _ in range(n): run()                                        # warm sessions, caches, the pool
+    modes = {"off": (0, None), "slow log (trace every delivery)": (1e9, None),
+             "sampler 100 Hz": (0, app.Sampler(100)), "sampler 1000 Hz": (0, app.Sampler(1000))}
+    best = dict.fromkeys(modes, float("inf"))
+    print(f"handle_delivery() over signed deliveries, reply to a local stub "
+          f"(best of {rounds} interleaved rounds of {n // rounds})")
+    try:
+        for _ in range(rounds):
+            for label, (ms, sampler) in modes.items():
+                app.SLOW_MS, app.profiler = ms, sampler
+                if sampler: sampler.pid = None; sampler.start()
+                best[label] = min(best[label], timeit(run, n // rounds))
+                if sampler: signal.setitimer(signal.ITIMER_PROF, 0)
+        for label, sec in best.items():
+            sampler = modes[label][1]
+            own = f"   in the sampler {sampler.stats['secs'] / (n // rounds * rounds) * 1e6:.2f} µs/delivery" \
+                  if sampler else ""
+            print(f"  {label:<34} {sec * 1e6:10.2f} µs/delivery  {sec / best['off'] - 1:+6.1%}{own}")
+        print("  hottest folded stacks (1000 Hz), last three frames:")
+        for line in modes["sampler 1000 Hz"][1].dump().splitlines()[:4]:
+            stack, cnt = line.rsplit(" ", 1)
+            print(f"    {cnt:>6}  ...;{';'.join(stack.split(';')[-3:])}")
+        lines = []
+        h = logging.Handler(); h.emit = lambda r: lines.append(r.getMessage())
+        app.logger.addHandler(h)
+        app.SLOW_MS, app.profiler = 1e-6, None
+        body = json.dumps({"destination": "Ubench", "events": [{
+            "type": "message", "mode": "active", "timestamp": 0, "webhookEventId": f"S{i}{time.time()}",
+            "deliveryContext": {"isRedelivery": False}, "replyToken": f"s{i}",
+            "source": {"type": "group", "groupId": "GS", "userId": f"US{i}"},
+            "message": {"type": "text", "id": "1", "quoteToken": "q", "text": text}}
+            for i, text in enumerate(["لغز", "سؤال 5", "تحليل"])]}, ensure_ascii=False)
+        app.handle_delivery(body, sign(body, "bench"))
+        app.logger.removeHandler(h)
+        print(f"  slow log line: {lines[-1] if lines else '(none)'}")
+    finally:
+        app.SLOW_MS, app.profiler = slow, prof
+        stub.shutdown()
+
+# ═══════════════════════════ SHARDS ══════════════════════════════════
+def proc_tree(root):
+    """root and all its live descendants."""
+    kids = {}
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as fh:
+                kids.setdefault(int(fh.read().rsplit(")", 1)[1].split()[1]), []).append(int(pid))
+        except (OSError, ValueError):
+            pass
+    out, todo = [], [root]
+    while todo:
+        pid = todo.pop(); out.append(pid); todo.extend(kids.get(pid, ()))
+    return out
+
+def cpu_secs(pids):
+    """user+system CPU seconds used so far by `pids`."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as fh:
+                f = fh.read().rsplit(")", 1)[1].split()
+            total += int(f[11]) + int(f[12])
+        except (OSError, ValueError):
+            pass
+    return total / os.sysconf("SC_CLK_TCK")
+
+@bench
+def shards():
+    """router.py in front of 1, 2, 4 backends: ring movement and balance, then
+    webhook throughput and CPU per delivery, and a backend added under load."""
+    import requests, router
+    n, conc, secret = int(os.getenv("BENCH_DELIVERIES", 3000)), int(os.getenv("BENCH_CONCURRENCY", 32)), "bench"
+    keys = [f"C{i:x}" for i in range(100000)]
+    print(f"consistent-hash ring, {router.VNODES} points per backend, {len(keys)} chats")
+    for k in (1, 2, 4, 8):
+        a = router.HashRing([f"b{i}" for i in range(k)])
+        b = router.HashRing([f"b{i}" for i in range(k + 1)])
+        moved  = sum(a.node(c) != b.node(c) for c in keys) / len(keys)
+        modulo = sum(hash(c) % k != hash(c) % (k + 1) for c in keys) / len(keys)
+        loads  = {}
+        for c in keys: loads[b.node(c)] = loads.get(b.node(c), 0) + 1
+        print(f"  {k} -> {k + 1} backends: moved {moved:6.1%} (ideal {1 / (k + 1):5.1%}, modulo {modulo:5.1%})"
+              f"   load max/mean at {k + 1}: {max(loads.values()) / (len(keys) / (k + 1)):.2f}")
+
+    # a backend's handover when the ring changes under it: 50k chats journaled, 3 -> 2 backends
+    real = app.cm.used, app.journal, dict(app.SHARD), app._shard_ring
+    try:
+        app.cm.used = rot = app.RotationStore()
+        app.journal = app.StateJournal(os.path.join(tempfile.mkdtemp(), "state.db"), rot)
+        for c in keys[:50000]: rot.draw(c, "سؤال", 300)
+        app.journal.flush()
+        print(f"\nring change on a backend with {len(rot)} chats journaled")
+        for nodes in (["a", "b", "c"], ["a", "b"]):
+            ring = router.HashRing(nodes)
+            app.adopt_ring(ring.version, ",".join(nodes), "a")
+            sh = app.SHARD
+            print(f"  -> {len(nodes)} backends: {sh['reload_secs'] * 1e3:6.1f} ms, "
+                  f"{sh['moved_out']} dropped and {sh['moved_in']} loaded in all, {len(rot)} chats held")
+    finally:
+        app.cm.used, app.journal, app._shard_ring = real[0], real[1], real[3]
+        app.SHARD.clear(); app.SHARD.update(real[2])
+
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubLineAPI)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    port = int(os.getenv("BENCH_PORT", 18080))
+    url, work = f"http://127.0.0.1:{port}", deliveries(n, secret)
+    events = sum(b.count('"webhookEventId"') for b, _ in work)
+    http = requests.Session()
+    http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=conc))
+    post = lambda d: http.post(url + "/callback", data=d[0].encode(), timeout=30,
+                               headers={"X-Line-Signature": d[1], "Content-Type": "application/json"})
+
+    def start(workers):
+        env = {"RATE_USER_PER_SEC": "0", "RATE_CHAT_PER_SEC": "0", **os.environ,
+               "LINE_CHANNEL_SECRET": secret, "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+               "LINE_API_HOST": f"http://127.0.0.1:{stub.server_address[1]}", "CONTENT_WATCH": "0",
+               "STATE_DB": os.path.join(tempfile.mkdtemp(), "state.db"), "PORT": str(port),
+               "SHARD_WORKERS": str(workers), "SHARD_PORT_BASE": str(port + 1)}
+        proc = subprocess.Popen([sys.executable, "router.py"], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_ring(proc, workers)
+        return proc
+
+    def wait_ring(proc, workers):
+        for _ in range(240):
+            try:
+                if len(http.get(url + "/health", timeout=5).json()["backends"]) == workers: return
+            except (requests.RequestException, ValueError):
+                pass
+            assert proc.poll() is None, "router exited"
+            time.sleep(0.25)
+        raise RuntimeError(f"ring never reached {workers} backends")
+
+    def drive(batch):
+        lat, codes = [], {}
+        def timed(d):
+            t = time.perf_counter()
+            r = post(d)
+            lat.append(time.perf_counter() - t)
+            codes[r.status_code] = codes.get(r.status_code, 0) + 1
+        with ThreadPoolExecutor(conc) as pool:
+            list(pool.map(timed, batch))
+        return sorted(lat), codes
+
+    print(f"\n/callback through router.py, {len(work)} deliveries ({events} events), concurrency {conc}, "
+          f"{os.cpu_count()} CPU(s)")
+    print(f"  {'backends':>8} {'deliv/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'router µs':>10} {'backends µs':>12}  status")
+    cpu = []
+    for workers in (1, 2, 4):
+        proc = start(workers)
+        try:
+            drive(work[:200])                                        # warm every backend
+            pids = proc_tree(proc.pid)
+            r0, b0 = cpu_secs([proc.pid]), cpu_secs(pids[1:])
+            t0 = time.perf_counter()
+            lat, codes = drive(work)
+            wall = time.perf_counter() - t0
+            r1, b1 = cpu_secs([proc.pid]), cpu_secs(proc_tree(proc.pid)[1:])
+        finally:
+            proc.terminate(); proc.wait(20)
+        cpu.append(((r1 - r0) / len(work), (b1 - b0) / len(work)))
+        print(f"  {workers:>8} {len(work) / wall:9.1f} {pct(lat, .5) * 1e3:8.2f} {pct(lat, .99) * 1e3:8.2f}"
+              f" {cpu[-1][0] * 1e6:10.0f} {cpu[-1][1] * 1e6:12.0f}  {codes}")
+    # a backend uses one core and the router one more: with a core each,
+    # N backends handle N / (backend CPU per delivery), up to the router's own limit
+    r, b = cpu[0]
+    print("  with a core per process (N / backend CPU, capped at 1 / router CPU): " + ", ".join(
+        f"{k} -> {min(k / b, 1 / r):.0f}/s" for k in (1, 2, 3, 4, 6)))
+
+    proc, codes, sent = start(2), {}, 0
+    try:
+        drive(work[:200])
+        os.kill(proc.pid, signal.SIGTTIN)
+        t0, chunk, grown = time.perf_counter(), 100, None
+        while True:                                          # keep the load on until it has joined, then a bit more
+            _, c = drive(work[sent % len(work):][:chunk]); sent += chunk
+            for k, v in c.items(): codes[k] = codes.get(k, 0) + v
+            if grown is not None and sent >= grown + 500: break
+            if grown is None and len(http.get(url + "/health", timeout=5).json()["backends"]) == 3:
+                grown, joined = sent, time.perf_counter() - t0
+            assert time.perf_counter() - t0 < 120, "backend never joined"
+        h = http.get(url + "/health", timeout=5).json()
+    finally:
+        proc.terminate(); proc.wait(20)
+    print(f"\nSIGTTIN under load, 2 -> 3 backends: joined after {joined:.1f} s and {grown} deliveries; "
+          f"{sent} sent, status {codes}")
+    print(f"  forwarded per backend {h['forwarded']}, {h['split']} deliveries split across backends")
+    stub.shutdown()
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHES:
+        BENCHES[name]()
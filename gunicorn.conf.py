@@ -0,0 +1,43 @@
+# Loaded automatically by gunicorn from the working directory; the command
+# line in the Procfile still sets bind/workers/worker class.
+import os
+
+def post_worker_init(worker):
+    # The app is loaded (and gevent patched in) by now: start the worker's
+    # background jobs, warmup first, before it takes its first request.
+    import app
+    app.scheduler.start()
+    if app.profiler is not None: app.profiler.start()
+
+def worker_exit(server, worker):
+    # Let queued webhook deliveries finish their replies before the worker dies.
+    import app
+    if app.ASYNC_DISPATCH:
+        app.dispatcher.drain(float(os.getenv("DISPATCH_DRAIN_TIMEOUT", 20)))
+    # Then write out the rotation/session state those replies changed.
+    if app.journal is not None:
+        app.journal.flush()
+    # And leave this worker's final counts for the merged /metrics.
+    app.write_metrics()
+
+def on_starting(server):
+    # Compile the content files into the snapshot every worker maps (see
+    # write_snapshot in app.py). A failed build only costs workers the slower
+    # text/JSON parse at startup.
+    import subprocess, sys
+    if os.getenv("CONTENT_SNAPSHOT", "content.snap"):
+        subprocess.run([sys.executable, "app.py", "build-snapshot"], check=False)
+    # Workers write their metric series to files in METRICS_DIR and /metrics
+    # merges them, so a scrape sees every worker whichever one answers it.
+    # Each master starts from an empty directory: its own temporary one,
+    # removed on exit, unless METRICS_DIR names one.
+    import glob, tempfile
+    if os.getenv("METRICS_DIR"):
+        os.makedirs(os.environ["METRICS_DIR"], exist_ok=True)
+        for f in glob.glob(os.path.join(os.environ["METRICS_DIR"], "*.json")): os.remove(f)
+    else:
+        os.environ["METRICS_DIR"] = server.metrics_tmp = tempfile.mkdtemp(prefix="bot-metrics-")
+
+def on_exit(server):
+    import shutil
+    if getattr(server, "metrics_tmp", None): shutil.rmtree(server.metrics_tmp, ignore_errors=True)
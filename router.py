@@ -0,0 +1,392 @@
+"""Front router: the bot as several single-worker backends, each chat pinned to one.
+
+    web: python router.py
+
+Every worker of `gunicorn app:app` keeps its own rotation, sessions and reply
+cache, and gunicorn gives each request to whichever worker accepts it first,
+so one chat's messages land on different workers and their state drifts
+apart. This process sits in front instead. It checks the LINE signature,
+hashes each event's chat (group, else room, else user) onto a consistent-hash
+ring of backends and forwards the event there. A chat's state then lives, hot,
+in exactly one process, with no shared store on the request path. (Game
+sessions are keyed by user; a user playing in two chats that live on
+different backends has one session in each.)
+
+    SHARD_WORKERS=N       spawn N local backends (default: one per CPU), each
+                          SHARD_BACKEND_CMD on port SHARD_PORT_BASE+i. SIGTTIN
+                          adds one and SIGTTOU retires the newest, like the
+                          same signals to a gunicorn master.
+    SHARD_BACKENDS=urls   or route to backends that are already running, e.g.
+                          on other hosts: comma-separated base URLs, or @path
+                          to a file of them, one per line, re-read on change.
+    SHARD_VNODES          ring points per backend (default 160).
+
+Rebalancing. With SHARD_VNODES points per backend, going from N to N+1
+backends moves ~1/(N+1) of the chats (a hash modulo N would move N/(N+1)). A
+new local backend joins the ring once it answers /health; a retired one
+leaves it before it is stopped, and drains its queue on the way out
+(gunicorn.conf.py). Every forwarded delivery carries the ring: its version
+in X-Shard-Ring, its members in X-Shard-Nodes and the backend's own URL in
+X-Shard-Self. A backend that sees a new version rebuilds the ring (run it
+with the same SHARD_VNODES), writes out its journal, drops the chats that
+now belong elsewhere and loads from STATE_DB the ones that moved to it
+(app.adopt_ring); chats that stay put are untouched. On one host the
+backends share STATE_DB, so a moved chat resumes where its old backend left
+it, at most STATE_FLUSH_EVERY behind. Backends on other hosts don't share
+the file; there a moved chat starts a fresh rotation pass, or picks up what
+that host last saved for it.
+
+A delivery whose events all belong to one backend (nearly all of them) is
+forwarded byte for byte with LINE's signature. One that spans backends is
+split into one body per backend, each signed again with the channel secret.
+If a forward fails the router answers 500 and LINE's redelivery retries;
+backends drop events they have already handled by webhookEventId.
+
+gunicorn itself can't do this: its workers accept from one shared socket, so
+the master never sees a request and has nothing to route on. The router is one
+process whose CPU bounds the whole deployment, so it speaks just the HTTP/1.1
+it needs on raw gevent sockets; pywsgi in and urllib3 out cost ~1 ms per
+delivery, as much as a backend's whole handling.
+"""
+if __name__ == "__main__":                  # imported (bench.py) it stays unpatched
+    from gevent import monkey; monkey.patch_all()
+
+import base64, bisect, hashlib, hmac, json, logging, os, shlex, signal, socket, ssl, subprocess, threading, time
+from urllib.parse import urlsplit
+import gevent
+from gevent.server import StreamServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger("router")
+
+SECRET      = os.getenv("LINE_CHANNEL_SECRET", "").encode()
+VNODES      = int(os.getenv("SHARD_VNODES", 160))
+BACKEND_CMD = os.getenv("SHARD_BACKEND_CMD",
+                        "gunicorn app:app --bind 127.0.0.1:{port} --workers 1 --timeout 30 --keep-alive 5 "
+                        "--log-level info --worker-class gevent --worker-connections 1000")
+FORWARD_TIMEOUT = float(os.getenv("SHARD_FORWARD_TIMEOUT", 25))
+POOL_SIZE       = int(os.getenv("SHARD_POOL_SIZE", 32))     # idle connections kept per backend
+
+# ═══════════════════════════ RING ════════════════════════════════════
+def _point(s):
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """Consistent hashing of chat ids onto backend URLs, `vnodes` points per
+    backend. Its version names the backend set, not the order it came in."""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        self.nodes   = sorted(set(nodes))
+        points       = sorted((_point(f"{n}#{i}"), n) for n in self.nodes for i in range(vnodes))
+        self.points  = [p for p, _ in points]
+        self.owners  = [n for _, n in points]
+        self.version = hashlib.blake2b("\n".join(self.nodes).encode(), digest_size=6).hexdigest()
+
+    def __len__(self): return len(self.nodes)
+
+    def node(self, key):
+        return self.owners[bisect.bisect(self.points, _point(key)) % len(self.points)]
+
+def chat_key(event):
+    """app.chat_id() on the raw webhook JSON."""
+    s = event.get("source") or {}
+    return s.get("groupId") or s.get("roomId") or s.get("userId") or ""
+
+def sign(body):
+    return base64.b64encode(hmac.new(SECRET, body, hashlib.sha256).digest()).decode()
+
+# ═══════════════════════════ HTTP ════════════════════════════════════
+MAX_HEAD = 65536
+
+def _fill(sock, buf, n):
+    while len(buf) < n:
+        chunk = sock.recv(65536)
+        if not chunk: raise ConnectionError("connection closed mid-message")
+        buf += chunk
+
+def read_message(sock, buf, interim=None):
+    """(start line, headers with lower-case names, body) of the next message
+    on a keep-alive connection, or None if the peer closed it in between.
+    `buf` holds bytes read past the previous message. `interim` is sent to
+    a client that asked for 100-continue."""
+    while (end := buf.find(b"\r\n\r\n")) < 0:
+        if len(buf) > MAX_HEAD: raise ValueError("header too large")
+        chunk = sock.recv(65536)
+        if not chunk:
+            if buf: raise ConnectionError("connection closed mid-message")
+            return None
+        buf += chunk
+    start, *lines = bytes(buf[:end]).decode("latin-1").split("\r\n")
+    del buf[:end + 4]
+    headers = {}
+    for line in lines:
+        k, _, v = line.partition(":")
+        headers[k.strip().lower()] = v.strip()
+    if interim and headers.get("expect", "").lower() == "100-continue": sock.sendall(interim)
+    if headers.get("transfer-encoding", "").lower().endswith("chunked"):
+        body = bytearray()
+        while True:
+            while (eol := buf.find(b"\r\n")) < 0: _fill(sock, buf, len(buf) + 1)
+            size = int(bytes(buf[:eol]).split(b";")[0], 16)
+            _fill(sock, buf, eol + 2 + size + 2)
+            body += buf[eol + 2:eol + 2 + size]
+            del buf[:eol + 2 + size + 2]
+            if not size: break                       # (trailers are not supported)
+        return start, headers, bytes(body)
+    n = int(headers.get("content-length") or 0)
+    _fill(sock, buf, n)
+    body = bytes(buf[:n]); del buf[:n]
+    return start, headers, body
+
+class Upstream:
+    """Keep-alive connections to one backend, reused across forwards."""
+
+    def __init__(self, url):
+        u = urlsplit(url)
+        self.addr = (u.hostname, u.port or (443 if u.scheme == "https" else 80))
+        self.tls  = ssl.create_default_context() if u.scheme == "https" else None
+        self.head = f"Host: {u.netloc}\r\n".encode()
+        self.idle = []               # (socket, read buffer)
+
+    def _connect(self):
+        sock = socket.create_connection(self.addr, timeout=2)
+        if self.tls: sock = self.tls.wrap_socket(sock, server_hostname=self.addr[0])
+        sock.settimeout(FORWARD_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, bytearray()
+
+    def request(self, method, path, body=b"", headers=b""):
+        """Status code of the response. A reused connection the backend has
+        since closed is retried once on a new one (backends drop a repeated
+        delivery by its event ids)."""
+        while True:
+            reused = bool(self.idle)
+            sock, buf = self.idle.pop() if reused else self._connect()
+            try:
+                sock.sendall(b"%s %s HTTP/1.1\r\n%s%sContent-Length: %d\r\n\r\n%s"
+                             % (method, path, self.head, headers, len(body), body))
+                msg = read_message(sock, buf)
+                if msg is None: raise ConnectionError("connection closed")
+            except (OSError, ValueError):
+                sock.close()
+                if reused: continue
+                raise
+            start, h, _ = msg
+            if h.get("connection", "").lower() == "close" or len(self.idle) >= POOL_SIZE: sock.close()
+            else: self.idle.append((sock, buf))
+            return int(start.split(" ", 2)[1])
+
+    def close(self):
+        while self.idle: self.idle.pop()[0].close()
+
+# ═══════════════════════════ BACKENDS ════════════════════════════════
+class LocalBackends:
+    """SHARD_WORKERS backend processes on consecutive ports. The first `live`
+    are in the ring; check() restarts any that died, on the same port, so
+    the ring doesn't change."""
+
+    def __init__(self, n, port_base, on_change):
+        self.port_base, self.on_change = port_base, on_change
+        self.procs = []
+        self.live  = 0
+        self.lock  = threading.Lock()
+        for i in range(n): self.procs.append(self._spawn(i))
+        gevent.spawn(self._join, n)
+
+    def url(self, i): return f"http://127.0.0.1:{self.port_base + i}"
+    def urls(self):   return [self.url(i) for i in range(self.live)]
+
+    def _spawn(self, i):
+        return subprocess.Popen(shlex.split(BACKEND_CMD.format(port=self.port_base + i)))
+
+    def _ready(self, i, timeout=60):
+        deadline, up = time.monotonic() + timeout, Upstream(self.url(i))
+        try:
+            while time.monotonic() < deadline and self.procs[i].poll() is None:
+                try:
+                    if up.request(b"GET", b"/health") == 200: return True
+                except (OSError, ValueError):
+                    pass
+                gevent.sleep(0.25)
+            return False
+        finally:
+            up.close()
+
+    def _join(self, n):
+        with self.lock:
+            for i in range(self.live, n):
+                if not self._ready(i): logger.error(f"backend {self.url(i)} did not come up")
+            self.live = n
+            self.on_change(self.urls())
+
+    def grow(self):
+        with self.lock:
+            i = len(self.procs)
+            self.procs.append(self._spawn(i))
+            if not self._ready(i):
+                logger.error(f"backend {self.url(i)} did not come up; not adding it")
+                self.procs.pop().terminate(); return
+            self.live = len(self.procs)
+            self.on_change(self.urls())
+
+    def shrink(self):
+        with self.lock:
+            if self.live <= 1: return
+            self.live -= 1
+            self.on_change(self.urls())              # out of the ring first,
+            p = self.procs.pop()
+        gevent.sleep(1)                              # then let forwards in flight land
+        p.terminate(); p.wait()
+
+    def check(self):
+        for i in range(self.live):
+            if self.procs[i].poll() is not None:
+                logger.warning(f"backend {self.url(i)} exited ({self.procs[i].returncode}); restarting")
+                self.procs[i] = self._spawn(i)
+
+    def stop(self):
+        for p in self.procs: p.terminate()
+        for p in self.procs: p.wait()
+
+class RemoteBackends:
+    """SHARD_BACKENDS: base URLs, or @path to a file of them re-read when it changes."""
+
+    def __init__(self, spec, on_change):
+        self.spec, self.on_change = spec, on_change
+        self.mtime, self.list = None, []
+        self.check()
+
+    def urls(self): return self.list
+
+    def check(self):
+        if self.spec.startswith("@"):
+            try: mtime = os.stat(self.spec[1:]).st_mtime
+            except OSError as e:
+                logger.error(f"SHARD_BACKENDS: {e}"); return
+            if mtime == self.mtime: return
+            self.mtime = mtime
+            with open(self.spec[1:]) as fh: text = fh.read()
+        else:
+            if self.list: return
+            text = self.spec.replace(",", "\n")
+        self.list = [u.strip().rstrip("/") for u in text.splitlines() if u.strip()]
+        self.on_change(self.list)
+
+    def stop(self): pass
+
+# ═══════════════════════════ ROUTER ══════════════════════════════════
+class Router:
+    """/callback forwards by chat, /health reports the ring."""
+
+    def __init__(self):
+        self.ring  = HashRing([])
+        self.up    = {}              # backend URL → Upstream
+        self.stats = {"deliveries": 0, "events": 0, "split": 0, "failed": 0,
+                      "bad_signature": 0, "rebalances": 0, "forwarded": {}}
+
+    def rebuild(self, urls):
+        ring = HashRing(urls)
+        if ring.version == self.ring.version: return
+        self.ring = ring
+        for url in set(self.up) - set(ring.nodes): self.up.pop(url).close()
+        self.stats["rebalances"] += 1
+        logger.info(f"ring {ring.version}: {len(ring)} backends {ring.nodes}")
+
+    def forward(self, ring, url, body, sig):
+        fw = self.stats["forwarded"]
+        fw[url] = fw.get(url, 0) + 1
+        up = self.up.get(url) or self.up.setdefault(url, Upstream(url))
+        try:
+            status = up.request(b"POST", b"/callback", body, b"Content-Type: application/json\r\n"
+                                b"X-Line-Signature: %s\r\nX-Shard-Ring: %s\r\nX-Shard-Nodes: %s\r\n"
+                                b"X-Shard-Self: %s\r\n" % (sig.encode(), ring.version.encode(),
+                                                            ",".join(ring.nodes).encode(), url.encode()))
+            if status < 300: return True
+            logger.warning(f"{url}: HTTP {status}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"{url}: {e!r}")
+        self.stats["failed"] += 1
+        return False
+
+    def callback(self, body, sig):
+        st = self.stats
+        if not hmac.compare_digest(sign(body), sig):
+            st["bad_signature"] += 1
+            return b"400 Bad Request"
+        try: delivery = json.loads(body)
+        except ValueError: return b"400 Bad Request"
+        ring, parts = self.ring, {}
+        events = delivery.get("events") or []
+        if not events: return b"200 OK"              # the console's "Verify" sends none
+        if not ring: return b"503 Service Unavailable"
+        for e in events: parts.setdefault(ring.node(chat_key(e)), []).append(e)
+        st["deliveries"] += 1; st["events"] += len(events)
+        if len(parts) == 1:
+            ok = self.forward(ring, next(iter(parts)), body, sig)
+        else:
+            st["split"] += 1
+            jobs = []
+            for url, evs in parts.items():
+                b = json.dumps({**delivery, "events": evs}, ensure_ascii=False, separators=(",", ":")).encode()
+                jobs.append(gevent.spawn(self.forward, ring, url, b, sign(b)))
+            gevent.joinall(jobs)
+            ok = all(g.value for g in jobs)
+        return b"200 OK" if ok else b"500 Internal Server Error"
+
+    def respond(self, method, path, headers, body):
+        """(status, content type, body) for one request."""
+        if path == "/callback" and method == "POST":
+            status = self.callback(body, headers.get("x-line-signature", ""))
+            return status, b"text/plain", b"OK" if status == b"200 OK" else b""
+        if path in ("/", "/health") and method in ("GET", "HEAD"):
+            return b"200 OK", b"application/json", json.dumps({
+                "ok": bool(self.ring), "ring": self.ring.version, "backends": self.ring.nodes, **self.stats}).encode()
+        return b"404 Not Found", b"text/plain", b""
+
+    def serve(self, sock, addr):
+        """StreamServer handler: requests on one keep-alive client connection."""
+        sock.settimeout(75)
+        buf = bytearray()
+        try:
+            while (msg := read_message(sock, buf, b"HTTP/1.1 100 Continue\r\n\r\n")) is not None:
+                start, headers, body = msg
+                method, path, version = start.split(" ", 2)
+                status, ctype, out = self.respond(method, path.split("?", 1)[0], headers, body)
+                keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                sock.sendall(b"HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n%s" % (
+                    status, ctype, len(out), b"" if keep else b"Connection: close\r\n",
+                    b"" if method == "HEAD" else out))
+                if not keep: break
+        except (OSError, ValueError):
+            pass                                     # dropped, timed out or not HTTP: just close
+        finally:
+            sock.close()
+
+def main():
+    router = Router()
+    if os.getenv("SHARD_BACKENDS"):
+        backends = RemoteBackends(os.getenv("SHARD_BACKENDS"), router.rebuild)
+    else:
+        backends = LocalBackends(int(os.getenv("SHARD_WORKERS") or os.cpu_count() or 1),
+                                 int(os.getenv("SHARD_PORT_BASE", 8100)), router.rebuild)
+        gevent.signal_handler(signal.SIGTTIN, lambda: gevent.spawn(backends.grow))
+        gevent.signal_handler(signal.SIGTTOU, lambda: gevent.spawn(backends.shrink))
+
+    def watch():
+        while True:
+            gevent.sleep(1)
+            try: backends.check()
+            except Exception as e: logger.error(f"backend check: {e}")
+    gevent.spawn(watch)
+
+    server = StreamServer(("0.0.0.0", int(os.getenv("PORT", 5000))), router.serve)
+    def stop():
+        server.stop(timeout=5)
+        backends.stop()
+    gevent.signal_handler(signal.SIGTERM, stop)
+    gevent.signal_handler(signal.SIGINT, stop)
+    logger.info(f"router listening on :{server.address[1]}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()